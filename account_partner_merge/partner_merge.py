@@ -19,22 +19,48 @@
 #
 ##############################################################################
 from openerp.osv import orm
+from openerp.tools import ormcache
 
 
 class MergePartnerAutomatic(orm.TransientModel):
     _inherit = 'base.partner.merge.automatic.wizard'
 
+    @ormcache()
+    def _get_commercial_partner_targets(self, cr):
+        """Return the (model, table) of the models storing the commercial
+        partner of their partner_id, like account.invoice"""
+        targets = []
+        for model_name, model in sorted(self.pool.models.iteritems()):
+            field = model._fields.get('commercial_partner_id')
+            if (model._auto and not model._abstract and
+                    field is not None and field.store and
+                    field.related == ('partner_id', 'commercial_partner_id')):
+                targets.append((model_name, model._table))
+        return tuple(targets)
+
     def _update_values(self, cr, uid, src_partners, dst_partner, context=None):
         """Make sure we don't forget to update the stored value of
-        invoice field commercial_partner_id
+        commercial_partner_id of the invoices (and other documents) of the
+        source partners, which now belong to the destination partner. Only
+        the rows whose value changes are written, in one query per table.
         """
         super(MergePartnerAutomatic, self)._update_values(
             cr, uid, src_partners, dst_partner, context=context
         )
 
-        invoice_obj = self.pool.get('account.invoice')
-        invoice_ids = invoice_obj.search(
-            cr, uid, [('partner_id', '=', dst_partner.id)], context=context
-        )
-        # call write to refresh stored value
-        invoice_obj.write(cr, uid, invoice_ids, {}, context=context)
+        # the invoices of the source partners point to dst_partner since
+        # _update_foreign_keys, but kept the commercial partner of the
+        # source partners
+        for model_name, table in self._get_commercial_partner_targets(cr):
+            cr.execute("""
+                UPDATE "%s" as t
+                   SET commercial_partner_id = p.commercial_partner_id
+                  FROM res_partner as p
+                 WHERE p.id = %%s
+                   AND t.partner_id = p.id
+                   AND t.commercial_partner_id IS DISTINCT FROM
+                       p.commercial_partner_id
+            """ % table, (dst_partner.id,))
+            if cr.rowcount:
+                self.pool[model_name].invalidate_cache(
+                    cr, uid, ['commercial_partner_id'], context=context)
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+
+class TestCommercialPartner(common.TransactionCase):
+
+    def _invoice(self, partner):
+        return self.env['account.invoice'].create({
+            'partner_id': partner.id,
+            'account_id': partner.property_account_receivable.id})
+
+    def test_merge_commercial_partner(self):
+        partner_model = self.env['res.partner']
+        src = partner_model.create({'name': 'Commercial Merge Test',
+                                    'is_company': True})
+        company = partner_model.create({'name': 'Commercial Merge Company',
+                                        'is_company': True})
+        dst = partner_model.create({'name': 'Commercial Merge Test',
+                                    'parent_id': company.id})
+        src_invoice = self._invoice(src)
+        dst_invoice = self._invoice(dst)
+        self.assertEqual(src_invoice.commercial_partner_id, src)
+        self.assertEqual(dst_invoice.commercial_partner_id, company)
+
+        wizard_model = self.env['base.partner.merge.automatic.wizard']
+        self.assertIn(('account.invoice', 'account_invoice'),
+                      wizard_model._get_commercial_partner_targets())
+        wizard_model._merge([src.id, dst.id], dst_partner=dst)
+        self.env.invalidate_all()
+        self.assertFalse(src.exists())
+        self.assertEqual(src_invoice.partner_id, dst)
+        self.assertEqual(src_invoice.commercial_partner_id, company)
+        self.assertEqual(dst_invoice.partner_id, dst)
+        self.assertEqual(dst_invoice.commercial_partner_id, company)
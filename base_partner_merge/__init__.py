@@ -1 +1,3 @@
 from . import base_partner_merge
+from . import merge_job
+from . import tests
@@ -13,6 +13,7 @@ backport module, to be removed when we switch to saas2 on the private servers
     'data': [
         'security/ir.model.access.csv',
         'base_partner_merge_view.xml',
+        'merge_job_view.xml',
     ],
     'installable': True,
 }
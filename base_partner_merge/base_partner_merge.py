@@ -1,29 +1,74 @@
 # -*- coding: utf-8 -*-
 
 from __future__ import absolute_import
+from contextlib import closing
 from email.utils import parseaddr
-import functools
 import htmlentitydefs
 import itertools
 import logging
 import operator
+import random
 import re
-from ast import literal_eval
-from openerp.tools import mute_logger
+import threading
+import time
+from psycopg2 import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from openerp.tools import mute_logger, ormcache
+from openerp.tools.lru import LRU
 
 # Validation Library https://pypi.python.org/pypi/validate_email/1.1
 from .validate_email import validate_email
+from .duplicate_detection import find_duplicate_groups
+from .merge_scheduler import partition_groups
+from .merge_stats import MergeStats
 
 import openerp
+from openerp import api
 from openerp.osv import orm
 from openerp.osv import fields
-from openerp.osv.orm import browse_record
+from openerp.service.model import PG_CONCURRENCY_ERRORS_TO_RETRY, \
+    MAX_TRIES_ON_CONCURRENCY_FAILURE
 from openerp.tools.translate import _
 
 pattern = re.compile(r"&(\w+?);")
+separator_pattern = re.compile(r';|/|:')
 
 _logger = logging.getLogger('base.partner.merge')
 
+# number of validated addresses kept by is_valid_email
+EMAIL_CACHE_SIZE = 100000
+
+# number of groups merged per transaction by merge_groups
+BATCH_CHUNK_SIZE = 500
+
+# number of partners indexed per statement in base.partner.merge.key
+KEY_CHUNK_SIZE = 10000
+
+# maximal depth of the partner hierarchies checked for cycles
+PARENT_MAX_DEPTH = 100
+
+# number of rows moved per statement by the lock-aware merge
+LOCK_BATCH_SIZE = 1000
+
+# number of groups inserted per statement in base.partner.merge.line
+LINE_CHUNK_SIZE = 1000
+
+# number of partners cleaned per statement by clean_emails
+CLEAN_CHUNK_SIZE = 1000
+
+# email domains never used to find a parent company by auto_set_parent_id
+PARENT_EXCLUDED_DOMAINS = ('gmail.com',)
+
+# number of partners updated per statement by auto_set_parent_id
+PARENT_CHUNK_SIZE = 1000
+
+# res.partner fields normalized in base.partner.merge.key, the email is
+# normalized in res_partner.email_normalized
+MERGE_KEY_FIELDS = ('name', 'vat')
+
+# res.partner columns computed from the email
+EMAIL_COLUMNS = ['email_normalized', 'email_domain']
+
 
 # http://www.php2python.com/wiki/function.html-entity-decode/
 def html_entity_decode_char(m, defs=None):
@@ -39,11 +84,24 @@ def html_entity_decode(string):
     return pattern.sub(html_entity_decode_char, string)
 
 
+valid_emails = LRU(EMAIL_CACHE_SIZE)
+
+
+def is_valid_email(email):
+    """Cached validate_email of the lowercased email"""
+    email = email.lower()
+    try:
+        return valid_emails[email]
+    except KeyError:
+        valid_emails[email] = result = validate_email(email)
+        return result
+
+
 def sanitize_email(partner_email):
     assert isinstance(partner_email, basestring) and partner_email
 
-    result = re.subn(r';|/|:', ',',
-                     html_entity_decode(partner_email or ''))[0].split(',')
+    result = separator_pattern.sub(
+        ',', html_entity_decode(partner_email or '')).split(',')
 
     emails = [parseaddr(email)[1]
               for item in result
@@ -51,25 +109,272 @@ def sanitize_email(partner_email):
 
     return [email.lower()
             for email in emails
-            if validate_email(email)]
+            if is_valid_email(email)]
+
+
+def sanitize_emails(partner_emails):
+    """Return the list of sanitized addresses of every email of
+    partner_emails, or an empty list for the empty ones"""
+    return [sanitize_email(partner_email) if partner_email else []
+            for partner_email in partner_emails]
 
 
 def is_integer_list(ids):
     return all(isinstance(i, (int, long)) for i in ids)
 
 
+def add_aggr_ids_column(cr, table):
+    """Add the integer[] column aggr_ids, unknown to the ORM, to table
+
+    To be called after _auto_init at every update of the module, which
+    drops the NOT NULL constraint of the columns unknown to the ORM."""
+    cr.execute("""SELECT data_type FROM information_schema.columns
+                   WHERE table_name = %s AND column_name = 'aggr_ids'""",
+               (table,))
+    row = cr.fetchone()
+    if row and row[0] != 'ARRAY':
+        # stringified list of ids of former versions
+        cr.execute('DELETE FROM "%s"' % table)
+        cr.execute('ALTER TABLE "%s" DROP COLUMN aggr_ids' % table)
+        row = None
+    if not row:
+        cr.execute('ALTER TABLE "%s" ADD COLUMN aggr_ids integer[] NOT NULL'
+                   % table)
+    else:
+        # the groups without partners are useless
+        cr.execute('DELETE FROM "%s" WHERE aggr_ids IS NULL' % table)
+        cr.execute('ALTER TABLE "%s" ALTER COLUMN aggr_ids SET NOT NULL'
+                   % table)
+
+
+def fetch_chunks(cr, name, query, params=None, size=KEY_CHUNK_SIZE):
+    """Iterate over the rows of query by chunks of size rows, through a
+    server side cursor so the whole result is never loaded in memory. The
+    transaction must not be committed before the iteration ends."""
+    cr.execute('DECLARE "%s" NO SCROLL CURSOR FOR %s' % (name, query),
+               params)
+    try:
+        while True:
+            cr.execute('FETCH %d FROM "%s"' % (size, name))
+            rows = cr.fetchall()
+            if not rows:
+                break
+            yield rows
+    finally:
+        cr.execute('CLOSE "%s"' % name)
+
+
+def normalize_email(email):
+    if not email:
+        return None
+    emails = sanitize_email(email)
+    return emails[0] if emails else ' '.join(email.lower().split()) or None
+
+
+def normalize_name(name):
+    return ' '.join((name or '').lower().split()) or None
+
+
+def normalize_vat(vat):
+    return re.sub(r'[\W_]+', '', (vat or '').upper(),
+                  flags=re.UNICODE) or None
+
+
+class MergePartnerKey(orm.Model):
+    """Normalized name and vat of every partner, so the duplicates can be
+    grouped without scanning the whole res_partner table. It is
+    maintained by create and _write of res.partner, which also catches the
+    recomputations of a stored computed name, and the keys of deleted
+    partners are removed by the foreign key."""
+    _name = 'base.partner.merge.key'
+    _log_access = False
+
+    _columns = {
+        'partner_id': fields.many2one('res.partner', 'Contact',
+                                      required=True, select=True,
+                                      ondelete='cascade'),
+        'name': fields.char('Name', select=True),
+        'vat': fields.char('VAT', select=True),
+    }
+
+    def _insert_keys(self, cr, rows):
+        """Insert the keys of rows (id, name, vat) of res_partner"""
+        if not rows:
+            return
+        partner_ids, names, vats = [], [], []
+        for partner_id, name, vat in rows:
+            partner_ids.append(partner_id)
+            names.append(normalize_name(name))
+            vats.append(normalize_vat(vat))
+        cr.execute("""INSERT INTO base_partner_merge_key
+                          (partner_id, name, vat)
+                      SELECT unnest(%s::integer[]), unnest(%s::varchar[]),
+                             unnest(%s::varchar[])""",
+                   (partner_ids, names, vats))
+
+    def update_keys(self, cr, partner_ids):
+        """Recompute the keys of partner_ids"""
+        for start in xrange(0, len(partner_ids), KEY_CHUNK_SIZE):
+            chunk = tuple(partner_ids[start:start + KEY_CHUNK_SIZE])
+            cr.execute("DELETE FROM base_partner_merge_key "
+                       "WHERE partner_id IN %s", (chunk,))
+            cr.execute("SELECT id, name, vat FROM res_partner "
+                       "WHERE id IN %s", (chunk,))
+            self._insert_keys(cr, cr.fetchall())
+
+    def _auto_init(self, cr, context=None):
+        res = super(MergePartnerKey, self)._auto_init(cr, context=context)
+        # the emails were normalized in this table before
+        # res_partner.email_normalized
+        cr.execute("ALTER TABLE base_partner_merge_key "
+                   "DROP COLUMN IF EXISTS email")
+        return res
+
+    def init(self, cr):
+        """Index the partners which are not indexed yet"""
+        last_id = 0
+        while True:
+            cr.execute("""SELECT id, name, vat
+                            FROM res_partner as p
+                           WHERE id > %s AND NOT EXISTS (
+                                 SELECT 1 FROM base_partner_merge_key as k
+                                  WHERE k.partner_id = p.id)
+                        ORDER BY id
+                           LIMIT %s""", (last_id, KEY_CHUNK_SIZE))
+            rows = cr.fetchall()
+            if not rows:
+                break
+            self._insert_keys(cr, rows)
+            last_id = rows[-1][0]
+            _logger.info('base.partner.merge.key: indexed partners up to '
+                         'id %s', last_id)
+
+
+def email_domain(email):
+    """Return the domain of a normalized email"""
+    if not email or '@' not in email:
+        return None
+    return email.rsplit('@', 1)[1] or None
+
+
+class ResPartner(orm.Model):
+    """The normalized email and its domain are stored in indexed columns,
+    so the partners are searched by email or domain with index scans."""
+    _inherit = 'res.partner'
+
+    _columns = {
+        'email_normalized': fields.char('Normalized Email', readonly=True,
+                                        select=True),
+        'email_domain': fields.char('Email Domain', readonly=True,
+                                    select=True),
+    }
+
+    def _update_email_columns(self, cr, partner_ids):
+        """Recompute email_normalized and email_domain of partner_ids"""
+        for start in xrange(0, len(partner_ids), KEY_CHUNK_SIZE):
+            chunk = tuple(partner_ids[start:start + KEY_CHUNK_SIZE])
+            cr.execute("SELECT id, email FROM res_partner "
+                       "WHERE id IN %s AND (email IS NOT NULL OR "
+                       "email_normalized IS NOT NULL)", (chunk,))
+            self._write_email_columns(cr, cr.fetchall())
+
+    def _write_email_columns(self, cr, rows):
+        """Write the normalized columns of rows (id, email) of
+        res_partner in one statement"""
+        if not rows:
+            return
+        partner_ids, emails, domains = [], [], []
+        for partner_id, email in rows:
+            email = normalize_email(email)
+            partner_ids.append(partner_id)
+            emails.append(email)
+            domains.append(email_domain(email))
+        cr.execute("""UPDATE res_partner as p
+                         SET email_normalized = v.email,
+                             email_domain = v.domain
+                        FROM (SELECT unnest(%s::integer[]) as id,
+                                     unnest(%s::varchar[]) as email,
+                                     unnest(%s::varchar[]) as domain) as v
+                       WHERE p.id = v.id""", (partner_ids, emails, domains))
+
+    def _auto_init(self, cr, context=None):
+        cr.execute("""SELECT 1 FROM information_schema.columns
+                       WHERE table_name = 'res_partner'
+                         AND column_name = 'email_normalized'""")
+        created = not cr.fetchone()
+        res = super(ResPartner, self)._auto_init(cr, context=context)
+        if not created:
+            # the invalid emails normalize to NULL, they must not be
+            # scanned again at every update
+            return res
+        # backfill the partners created before the columns
+        last_id = 0
+        while True:
+            cr.execute("""SELECT id, email FROM res_partner
+                           WHERE id > %s AND email IS NOT NULL
+                        ORDER BY id
+                           LIMIT %s""", (last_id, KEY_CHUNK_SIZE))
+            rows = cr.fetchall()
+            if not rows:
+                break
+            self._write_email_columns(cr, rows)
+            last_id = rows[-1][0]
+            _logger.info('res.partner: normalized the emails up to id %s',
+                         last_id)
+        return res
+
+    def create(self, cr, uid, vals, context=None):
+        res = super(ResPartner, self).create(cr, uid, vals, context=context)
+        self.pool['base.partner.merge.key'].update_keys(cr, [res])
+        # the email may come from the defaults or the copied partner
+        self._update_email_columns(cr, [res])
+        self.invalidate_cache(cr, uid, EMAIL_COLUMNS, [res], context=context)
+        return res
+
+    def _write(self, cr, uid, ids, vals, context=None):
+        # write and the recomputation of the stored computed fields both
+        # store their values through _write
+        res = super(ResPartner, self)._write(cr, uid, ids, vals,
+                                             context=context)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        if set(vals).intersection(MERGE_KEY_FIELDS):
+            self.pool['base.partner.merge.key'].update_keys(cr, list(ids))
+        if 'email' in vals:
+            self._update_email_columns(cr, list(ids))
+            self.invalidate_cache(cr, uid, EMAIL_COLUMNS, list(ids),
+                                  context=context)
+        return res
+
+
 class MergePartnerLine(orm.TransientModel):
+    """A group of partners to merge. The partner ids are stored in the
+    integer[] column aggr_ids, which is not known by the ORM: the lines are
+    inserted in SQL straight from the grouping query and read with
+    get_aggr_ids."""
     _name = 'base.partner.merge.line'
 
     _columns = {
         'wizard_id': fields.many2one('base.partner.merge.automatic.wizard',
                                      'Wizard'),
         'min_id': fields.integer('MinID'),
-        'aggr_ids': fields.char('Ids', required=True),
     }
 
     _order = 'min_id asc'
 
+    def _auto_init(self, cr, context=None):
+        res = super(MergePartnerLine, self)._auto_init(cr, context=context)
+        add_aggr_ids_column(cr, self._table)
+        return res
+
+    def get_aggr_ids(self, cr, uid, ids, context=None):
+        """Return a dictionary {line id: list of partner ids}"""
+        if not ids:
+            return {}
+        cr.execute("SELECT id, aggr_ids FROM base_partner_merge_line "
+                   "WHERE id IN %s", (tuple(ids),))
+        return dict(cr.fetchall())
+
 
 class MergePartnerAutomatic(orm.TransientModel):
     """
@@ -107,6 +412,34 @@ class MergePartnerAutomatic(orm.TransientModel):
         'exclude_journal_item': fields.boolean('Journal Items associated'
                                                ' to the contact'),
         'maximum_group': fields.integer("Maximum of Group of Contacts"),
+        'fuzzy_match': fields.boolean(
+            'Similar names',
+            help="Also find contacts with similar but not identical names, "
+                 "like 'ACME S.A.' and 'Acme SA'. The other criteria are "
+                 "ignored."),
+        'fuzzy_threshold': fields.float(
+            'Similarity threshold',
+            help="Between 0 and 1, the higher the more similar the names "
+                 "must be"),
+        'merge_workers': fields.integer(
+            'Parallel merges',
+            help="Number of groups of contacts merged at the same time by "
+                 "the automatic merge"),
+        'lock_timeout': fields.integer(
+            'Lock timeout (ms)',
+            help="When set, the documents of the merged contacts are "
+                 "redirected by small batches, each one committed on its "
+                 "own, skipping the rows locked by other transactions and "
+                 "waiting at most this time for a lock, so the other users "
+                 "are not blocked during the merge. Requires PostgreSQL "
+                 "9.5."),
+        'merge_stats': fields.text('Statistics of the last merges',
+                                   readonly=True),
+        'impact_report': fields.text(
+            'Impact of the merge', readonly=True,
+            help="Rows which would be redirected to the destination "
+                 "contacts, computed by the dry run. The excluded contacts "
+                 "are not taken into account."),
     }
 
     def default_get(self, cr, uid, fields, context=None):
@@ -126,7 +459,9 @@ class MergePartnerAutomatic(orm.TransientModel):
         return res
 
     _defaults = {
-        'state': 'option'
+        'state': 'option',
+        'fuzzy_threshold': 0.8,
+        'merge_workers': 1,
     }
 
     def get_fk_on(self, cr, table):
@@ -148,6 +483,37 @@ class MergePartnerAutomatic(orm.TransientModel):
         """
         return cr.execute(q, (table,))
 
+    @ormcache()
+    def _get_fk_catalog(self, cr):
+        """Return the single column foreign keys pointing to res_partner.id
+
+        The result is a tuple of (table, column, other_columns) and is cached
+        on the model, so it is rebuilt whenever the registry is reloaded (i.e.
+        when a module adding new foreign keys is installed or updated).
+        """
+        self.get_fk_on(cr, 'res_partner')
+        foreign_keys = [
+            (table, column) for table, column in cr.fetchall()
+            if 'base_partner_merge_' not in table
+        ]
+        if not foreign_keys:
+            return ()
+
+        cr.execute("""SELECT table_name, column_name
+                        FROM information_schema.columns
+                       WHERE table_name IN %s
+                    ORDER BY ordinal_position""",
+                   (tuple(set(table for table, column in foreign_keys)),))
+        table_columns = {}
+        for table, column in cr.fetchall():
+            table_columns.setdefault(table, []).append(column)
+
+        return tuple(
+            (table, column,
+             tuple(c for c in table_columns.get(table, []) if c != column))
+            for table, column in foreign_keys
+        )
+
     def _update_foreign_keys(self, cr, uid, src_partners,
                              dst_partner, context=None):
         _logger.debug('_update_foreign_keys for dst_partner: %s for '
@@ -157,45 +523,39 @@ class MergePartnerAutomatic(orm.TransientModel):
 
         # find the many2one relation to a partner
         proxy = self.pool.get('res.partner')
-        self.get_fk_on(cr, 'res_partner')
-
-        # ignore two tables
-
-        for table, column in cr.fetchall():
-            if 'base_partner_merge_' in table:
-                continue
-            partner_ids = tuple(map(int, src_partners))
-
-            query = ("SELECT column_name FROM information_schema.columns"
-                     "  WHERE table_name LIKE '%s'") % (table)
-            cr.execute(query, ())
-            columns = []
-            for data in cr.fetchall():
-                if data[0] != column:
-                    columns.append(data[0])
+        partner_ids = tuple(map(int, src_partners))
 
+        for table, column, columns in self._get_fk_catalog(cr):
             query_dic = {
                 'table': table,
                 'column': column,
-                'value': columns[0],
+                'value': columns and columns[0],
             }
-            if len(columns) <= 1:
-                # unique key treated
+            if len(columns) == 1:
+                # unique key treated: move the rows of all the source
+                # partners at once, but only one row per value and only
+                # if the destination partner is not linked to it yet
                 query = """
                     UPDATE "%(table)s" as ___tu
-                    SET %(column)s = %%s
+                    SET %(column)s = %%(dst)s
                     WHERE
-                        %(column)s = %%s AND
+                        %(column)s IN %%(src)s AND
                         NOT EXISTS (
                             SELECT 1
                             FROM "%(table)s" as ___tw
                             WHERE
-                                %(column)s = %%s AND
+                                ___tw.%(column)s = %%(dst)s AND
                                 ___tu.%(value)s = ___tw.%(value)s
+                        ) AND
+                        ___tu.%(column)s = (
+                            SELECT min(___tx.%(column)s)
+                            FROM "%(table)s" as ___tx
+                            WHERE
+                                ___tx.%(column)s IN %%(src)s AND
+                                ___tu.%(value)s = ___tx.%(value)s
                         )""" % query_dic
-                for partner_id in partner_ids:
-                    cr.execute(query, (dst_partner.id, partner_id,
-                                       dst_partner.id))
+                cr.execute(query, {'dst': dst_partner.id,
+                                   'src': partner_ids})
             else:
                 cr.execute("SAVEPOINT recursive_partner_savepoint")
                 try:
@@ -205,26 +565,194 @@ class MergePartnerAutomatic(orm.TransientModel):
 
                     if (column == proxy._parent_name and
                             table == 'res_partner'):
-                        query = """
-                            WITH RECURSIVE cycle(id, parent_id) AS (
-                                    SELECT id, parent_id FROM res_partner
-                                UNION
-                                    SELECT cycle.id, res_partner.parent_id
-                                    FROM   res_partner, cycle
-                                    WHERE  res_partner.id = cycle.parent_id
-                                      AND  cycle.id != cycle.parent_id
-                            )
-                            SELECT id FROM cycle
-                                WHERE id = parent_id AND id = %s
-                        """
-                        cr.execute(query, (dst_partner.id,))
-                        if cr.fetchall():
+                        if self._find_parent_cycles(cr, [dst_partner.id]):
                             cr.execute("ROLLBACK TO SAVEPOINT "
                                        "recursive_partner_savepoint")
                 finally:
                     cr.execute("RELEASE SAVEPOINT "
                                "recursive_partner_savepoint")
 
+    def _move_references(self, cr, uid, groups, lock_timeout,
+                         context=None):
+        """Point the references to the source partners of groups to their
+        destination partner before the merges, in short transactions of a
+        separate cursor, so that the rows stay locked for one batch only.
+
+        The foreign keys and the reference fields are moved by batches of
+        LOCK_BATCH_SIZE rows, each committed on its own. A batch waits at
+        most lock_timeout milliseconds for a lock and skips the rows locked
+        by other transactions, which are retried after a pause, while no
+        lock is held. Moving a reference again is harmless, so the batches
+        committed before a failure of a merge are kept. The rows left, the
+        unique keys and the parents are moved by the merge itself.
+
+        Nothing is done if a transaction is open on cr, as its snapshot
+        would conflict with the rows moved in between.
+
+        :param groups: list of (dst_id, partner_ids), the destination is
+                       chosen as in _merge when dst_id is not in
+                       partner_ids
+        """
+        if cr._cnx.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            return
+        proxy = self.pool['res.partner']
+        with closing(openerp.registry(cr.dbname).cursor()) as move_cr:
+            src_ids, dst_ids, seen = [], [], set()
+            for dst_id, partner_ids in groups:
+                partner_ids = proxy.exists(move_cr, uid, list(partner_ids),
+                                           context=context)
+                # the merge reports the partners of several groups
+                if len(partner_ids) < 2 or seen.intersection(partner_ids):
+                    continue
+                seen.update(partner_ids)
+                if dst_id not in partner_ids:
+                    dst_id = self._get_ordered_partner(
+                        move_cr, uid, partner_ids, context=context)[-1].id
+                group_src_ids = [i for i in partner_ids if i != dst_id]
+                try:
+                    self._check_merge_rights(move_cr, uid, partner_ids,
+                                             group_src_ids, context=context)
+                except orm.except_orm:
+                    # reported by the merge
+                    continue
+                src_ids.extend(group_src_ids)
+                dst_ids.extend([dst_id] * len(group_src_ids))
+            move_cr.commit()
+            if not src_ids:
+                return
+
+            for table, column, columns in self._get_fk_catalog(move_cr):
+                if len(columns) == 1 or (column == proxy._parent_name and
+                                         table == 'res_partner'):
+                    continue
+                self._move_rows(move_cr, table, column, 'TRUE', src_ids,
+                                dst_ids, lock_timeout)
+
+            updated = []
+            model_targets, reference_targets = self._get_reference_targets(
+                move_cr)
+            for model, table, condition, field_id, unique in model_targets:
+                if unique:
+                    # the duplicates are left to the merge
+                    continue
+                if self._move_rows(move_cr, table, field_id, condition,
+                                   src_ids, dst_ids, lock_timeout):
+                    updated.append((model, field_id))
+            src_refs = ['res.partner,%d' % i for i in src_ids]
+            dst_refs = ['res.partner,%d' % i for i in dst_ids]
+            for model, table, column in reference_targets:
+                if self._move_rows(move_cr, table, column, 'TRUE', src_refs,
+                                   dst_refs, lock_timeout):
+                    updated.append((model, column))
+        self._invalidate_reference_caches(cr, uid, updated, context=context)
+
+    def _move_rows(self, cr, table, column, condition, src_values,
+                   dst_values, lock_timeout):
+        """Point column of the rows of table matching condition to
+        dst_values instead of src_values, committing every batch, see
+        _move_references
+
+        :return: the number of moved rows
+        """
+        query_dic = {'table': table, 'column': column,
+                     'condition': condition}
+        batch_query = """
+            UPDATE "%(table)s" as ___tu
+            SET %(column)s = ___m.dst
+            FROM (SELECT unnest(%%(src)s) as src,
+                         unnest(%%(dst)s) as dst) as ___m
+            WHERE ___tu.%(column)s = ___m.src AND ___tu.ctid = ANY(ARRAY(
+                SELECT ctid FROM "%(table)s"
+                WHERE %(condition)s AND %(column)s = ANY(%%(src)s)
+                LIMIT %%(limit)s FOR UPDATE SKIP LOCKED))""" % query_dic
+        params = {'src': src_values, 'dst': dst_values,
+                  'limit': LOCK_BATCH_SIZE}
+        moved = 0
+        for tries in itertools.count(1):
+            while True:
+                try:
+                    cr.execute("SET LOCAL lock_timeout = %s",
+                               (lock_timeout,))
+                    cr.execute(batch_query, params)
+                    rowcount = cr.rowcount
+                    cr.commit()
+                except OperationalError as e:
+                    # lock timeouts, and rows updated by others since the
+                    # snapshot when the cursor is REPEATABLE READ
+                    cr.rollback()
+                    if e.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY:
+                        raise
+                    break
+                moved += rowcount
+                if rowcount < LOCK_BATCH_SIZE:
+                    break
+
+            cr.execute('SELECT 1 FROM "%(table)s" '
+                       'WHERE %(condition)s AND %(column)s = ANY(%%s) '
+                       'LIMIT 1' % query_dic, (src_values,))
+            left = cr.fetchone()
+            cr.rollback()
+            if not left or tries >= MAX_TRIES_ON_CONCURRENCY_FAILURE:
+                break
+            wait_time = random.uniform(0.0, 2 ** tries)
+            _logger.info('rows of %s locked, retry moving %s in %.04f '
+                         'sec...', table, column, wait_time)
+            time.sleep(wait_time)
+        return moved
+
+    # models pointing to a partner through a (model, res_id) pair of columns,
+    # the model column being either a char or a many2one to ir.model, and
+    # the column unique for a given (model, res_id) if any
+    _reference_models = [
+        ('base.calendar', 'model_id.model', 'res_id', None),
+        ('ir.attachment', 'res_model', 'res_id', None),
+        ('mail.followers', 'res_model', 'res_id', 'partner_id'),
+        ('mail.message', 'model', 'res_id', None),
+        ('marketing.campaign.workitem', 'object_id.model', 'res_id', None),
+        ('ir.model.data', 'model', 'res_id', None),
+    ]
+
+    @ormcache()
+    def _get_reference_targets(self, cr):
+        """Return the columns pointing to partners without a foreign key
+
+        :return: a tuple (model_targets, reference_targets) with
+                 model_targets the (model, table, condition on the model
+                 column, id column, unique column) of _reference_models and
+                 reference_targets the (model, table, column) of the stored
+                 reference fields
+        """
+        model_targets = []
+        for model, field_model, field_id, unique in self._reference_models:
+            proxy = self.pool.get(model)
+            if proxy is None:
+                continue
+            if '.' in field_model:
+                condition = ("%s IN (SELECT id FROM ir_model "
+                             "WHERE model = 'res.partner')" %
+                             field_model.split('.')[0])
+            else:
+                condition = "%s = 'res.partner'" % field_model
+            model_targets.append((model, proxy._table, condition,
+                                  field_id, unique))
+
+        cr.execute("SELECT model, name FROM ir_model_fields "
+                   "WHERE ttype = 'reference'")
+        reference_targets = []
+        for model, name in cr.fetchall():
+            if model == 'ir.property':
+                continue
+            proxy_model = self.pool.get(model)
+            # ignore old tables and views
+            if proxy_model is None or not proxy_model._auto:
+                continue
+            column = proxy_model._columns.get(name)
+            if column is None or isinstance(column, fields.function):
+                continue
+            reference_targets.append((model, proxy_model._table, name))
+
+        return tuple(model_targets), tuple(reference_targets)
+
     def _update_reference_fields(self, cr, uid, src_partners, dst_partner,
                                  context=None):
         _logger.debug('_update_reference_fields for dst_partner: %s for '
@@ -232,64 +760,252 @@ class MergePartnerAutomatic(orm.TransientModel):
                       dst_partner.id,
                       list(map(operator.attrgetter('id'), src_partners)))
 
-        def update_records(model, src, field_model='model', field_id='res_id',
-                           context=None):
-            proxy = self.pool.get(model)
-            if proxy is None:
-                return
-            domain = [(field_model, '=', 'res.partner'),
-                      (field_id, '=', src.id)]
-            ids = proxy.search(cr, openerp.SUPERUSER_ID,
-                               domain, context=context)
-            return proxy.write(cr, openerp.SUPERUSER_ID, ids,
-                               {field_id: dst_partner.id}, context=context)
-
-        update_records = functools.partial(update_records, context=context)
-
-        for partner in src_partners:
-            update_records('base.calendar', src=partner,
-                           field_model='model_id.model')
-            update_records('ir.attachment', src=partner,
-                           field_model='res_model')
-            update_records('mail.followers', src=partner,
-                           field_model='res_model')
-            update_records('mail.message', src=partner)
-            update_records('marketing.campaign.workitem', src=partner,
-                           field_model='object_id.model')
-            update_records('ir.model.data', src=partner)
-
-        proxy = self.pool['ir.model.fields']
-        domain = [('ttype', '=', 'reference')]
-        record_ids = proxy.search(cr, openerp.SUPERUSER_ID, domain,
-                                  context=context)
+        partner_ids = tuple(map(int, src_partners))
+        model_targets, reference_targets = self._get_reference_targets(cr)
 
-        for record in proxy.browse(cr, openerp.SUPERUSER_ID, record_ids,
-                                   context=context):
-            try:
-                proxy_model = self.pool[record.model]
-            except KeyError:
-                # ignore old tables
-                continue
+        updated = []
+        for model, table, condition, field_id, unique in model_targets:
+            query_dic = {
+                'table': table,
+                'condition': condition,
+                'field_id': field_id,
+                'unique': unique,
+            }
+            query = ('UPDATE "%(table)s" as ___tu SET %(field_id)s = %%(dst)s '
+                     'WHERE %(condition)s AND %(field_id)s IN %%(src)s')
+            if unique:
+                # only one row per unique value, and only if the
+                # destination partner has none yet, the source rows left
+                # are removed with the source partners
+                query += """ AND
+                    NOT EXISTS (
+                        SELECT 1
+                        FROM "%(table)s" as ___tw
+                        WHERE
+                            %(condition)s AND
+                            ___tw.%(field_id)s = %%(dst)s AND
+                            ___tw.%(unique)s = ___tu.%(unique)s
+                    ) AND
+                    ___tu.%(field_id)s = (
+                        SELECT min(___tx.%(field_id)s)
+                        FROM "%(table)s" as ___tx
+                        WHERE
+                            %(condition)s AND
+                            ___tx.%(field_id)s IN %%(src)s AND
+                            ___tx.%(unique)s = ___tu.%(unique)s
+                    )"""
+            cr.execute(query % query_dic,
+                       {'dst': dst_partner.id, 'src': partner_ids})
+            if cr.rowcount:
+                updated.append((model, field_id))
+
+        for model, table, column in reference_targets:
+            cr.execute('UPDATE "%(table)s" SET %(column)s = %%s '
+                       'WHERE %(column)s IN %%s' % {
+                           'table': table,
+                           'column': column,
+                       }, ('res.partner,%d' % dst_partner.id,
+                           tuple('res.partner,%d' % partner_id
+                                 for partner_id in partner_ids)))
+            if cr.rowcount:
+                updated.append((model, column))
+
+        self._invalidate_reference_caches(cr, uid, updated, context=context)
+
+    def _invalidate_reference_caches(self, cr, uid, updated, context=None):
+        """The references are updated in SQL, drop what the ORM caches for
+        the fields which rows were actually updated
+
+        :param updated: list of (model, field name)
+        """
+        for model, field_name in updated:
+            if model == 'ir.model.data':
+                # the xmlid lookups are cached in the registry ormcache,
+                # which can only be cleared as a whole
+                self.pool[model].clear_caches()
+            self.pool[model].invalidate_cache(cr, uid, [field_name],
+                                              context=context)
 
-            if record.model == 'ir.property':
-                continue
+    def _get_merge_impact(self, cr, src_partner_ids):
+        """Count the rows the merge of src_partner_ids would rewrite
 
-            field_type = proxy_model._columns.get(record.name).__class__._type
+        Only aggregate SELECT queries are run, one per referencing table,
+        so the report can be computed on a hot standby.
 
-            if field_type == 'function':
-                continue
+        :return: sorted list of (table, column, partner id, row count)
+        """
+        if not src_partner_ids:
+            return []
+        partner_ids = tuple(src_partner_ids)
+        result = []
+
+        table_columns = {}
+        for table, column, other_columns in self._get_fk_catalog(cr):
+            table_columns.setdefault(table, []).append(column)
+        for table, columns in table_columns.iteritems():
+            cr.execute("""
+                SELECT column_name, partner_id, count(*)
+                FROM (SELECT unnest(ARRAY[%(names)s]) as column_name,
+                             unnest(ARRAY[%(columns)s]) as partner_id
+                      FROM "%(table)s"
+                      WHERE %(condition)s) as refs
+                WHERE partner_id IN %%s
+                GROUP BY column_name, partner_id
+            """ % {
+                'table': table,
+                'names': ', '.join("'%s'::varchar" % column
+                                   for column in columns),
+                'columns': ', '.join('"%s"' % column for column in columns),
+                'condition': ' OR '.join('"%s" IN %%s' % column
+                                         for column in columns),
+            }, (partner_ids,) * (len(columns) + 1))
+            result.extend((table,) + row for row in cr.fetchall())
+
+        model_targets, reference_targets = self._get_reference_targets(cr)
+        for dummy, table, condition, field_id, unique in model_targets:
+            cr.execute('SELECT %(field_id)s, count(*) FROM "%(table)s" '
+                       'WHERE %(condition)s AND %(field_id)s IN %%s '
+                       'GROUP BY %(field_id)s' % {
+                           'table': table,
+                           'condition': condition,
+                           'field_id': field_id,
+                       }, (partner_ids,))
+            result.extend((table, field_id) + row for row in cr.fetchall())
+
+        for dummy, table, column in reference_targets:
+            cr.execute('SELECT %(column)s, count(*) FROM "%(table)s" '
+                       'WHERE %(column)s IN %%s GROUP BY %(column)s' % {
+                           'table': table,
+                           'column': column,
+                       }, (tuple('res.partner,%d' % partner_id
+                                 for partner_id in partner_ids),))
+            result.extend((table, column, int(value.split(',')[1]), count)
+                          for value, count in cr.fetchall())
+
+        return sorted(result)
+
+    def _get_group_sources(self, cr, groups):
+        """Return the ids of the partners of the (min_id, aggr_ids) groups
+        which are not the destination of their group, in SQL"""
+        group_indexes, partner_ids = [], []
+        for index, (min_id, aggr_ids) in enumerate(groups):
+            group_indexes.extend([index] * len(aggr_ids))
+            partner_ids.extend(aggr_ids)
+        if not partner_ids:
+            return []
+        # same order as _get_ordered_partner, whose last partner is the
+        # destination, except for the partners created at the same time
+        cr.execute("""
+            SELECT partner_id
+            FROM (SELECT m.partner_id,
+                         row_number() OVER (
+                             PARTITION BY m.group_index
+                             ORDER BY p.active, p.create_date, p.id
+                         ) as position
+                  FROM (SELECT unnest(%s::integer[]) as group_index,
+                               unnest(%s::integer[]) as partner_id) as m
+                  JOIN res_partner p ON p.id = m.partner_id) as ranked
+            WHERE position > 1
+        """, (group_indexes, partner_ids))
+        return [row[0] for row in cr.fetchall()]
+
+    def get_merge_impact(self, cr, uid, partner_ids, context=None):
+        """Report the rows the merge of partner_ids would rewrite, without
+        changing anything. See _get_merge_impact."""
+        ordered_partners = self._get_ordered_partner(cr, uid, partner_ids,
+                                                     context=context)
+        return self._get_merge_impact(
+            cr, [partner.id for partner in ordered_partners[:-1]])
+
+    def dry_run_cb(self, cr, uid, ids, context=None):
+        """Compute the impact of the merge of the current selection, or of
+        all the candidate groups when no selection is made yet"""
+        assert is_integer_list(ids)
 
-            for partner in src_partners:
-                domain = [
-                    (record.name, '=', 'res.partner,%d' % partner.id)
-                ]
-                model_ids = proxy_model.search(cr, openerp.SUPERUSER_ID,
-                                               domain, context=context)
-                values = {
-                    record.name: 'res.partner,%d' % dst_partner.id,
-                }
-                proxy_model.write(cr, openerp.SUPERUSER_ID, model_ids, values,
-                                  context=context)
+        context = dict(context or {}, active_test=False)
+        this = self.browse(cr, uid, ids[0], context=context)
+        if this.state == 'selection':
+            src_partner_ids = [partner.id for partner in this.partner_ids
+                               if partner != this.dst_partner_id]
+        else:
+            if this.fuzzy_match:
+                groups = self._fuzzy_groups(cr, uid, this, context=context)
+            else:
+                cr.execute(self._generate_query(
+                    self._compute_selected_groupby(this),
+                    this.maximum_group))
+                groups = cr.fetchall()
+            src_partner_ids = self._get_group_sources(cr, groups)
+
+        totals = {}
+        for table, column, partner_id, count in self._get_merge_impact(
+                cr, src_partner_ids):
+            rows, partners = totals.get((table, column), (0, 0))
+            totals[(table, column)] = (rows + count, partners + 1)
+        report = [_('%s contacts would be merged away.')
+                  % len(src_partner_ids)]
+        report.extend(_('%s.%s: %s rows of %s contacts')
+                      % (table, column, rows, partners)
+                      for (table, column), (rows, partners)
+                      in sorted(totals.iteritems()))
+        this.write({'impact_report': '\n'.join(report)})
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': this._name,
+            'res_id': this.id,
+            'view_mode': 'form',
+            'target': 'new',
+        }
+
+    def _get_merge_columns(self, cr, uid, context=None):
+        """Columns of res.partner stored in its table whose values are
+        merged"""
+        columns = self.pool['res.partner']._columns
+        return sorted(name for name, column in columns.iteritems()
+                      if column._classic_write and name != 'id')
+
+    def _get_merge_plan(self, cr, uid, src_partner_ids, dst_partner_id,
+                        context=None):
+        """Compute the values given to the destination partner, reading
+        the columns of the whole group in one query
+
+        As in a write of the partners one after the other, the last
+        source partner with a value wins, unless the destination partner
+        has one.
+
+        :return: dictionary {column: (partner id, value)} of the columns
+                 whose value changes
+        """
+        columns = self._get_merge_columns(cr, uid, context=context)
+        partner_ids = list(src_partner_ids) + [dst_partner_id]
+        cr.execute('SELECT id, %s FROM res_partner WHERE id IN %%s'
+                   % ', '.join('"%s"' % column for column in columns),
+                   (tuple(partner_ids),))
+        rows = dict((row[0], row[1:]) for row in cr.fetchall())
+
+        plan = {}
+        for index, column in enumerate(columns):
+            for partner_id in reversed(partner_ids):
+                value = rows.get(partner_id, ())[index:index + 1]
+                if value and value[0]:
+                    if partner_id != dst_partner_id:
+                        plan[column] = (partner_id, value[0])
+                    break
+        return plan
+
+    def get_merge_plan(self, cr, uid, partner_ids, context=None):
+        """Preview the values the merge of partner_ids gives to the
+        destination partner, without changing anything
+
+        :return: (destination partner id,
+                  {column: (source partner id, value)})
+        """
+        ordered_partners = self._get_ordered_partner(cr, uid, partner_ids,
+                                                     context=context)
+        dst_partner_id = ordered_partners[-1].id
+        src_partner_ids = [partner.id for partner in ordered_partners[:-1]]
+        return dst_partner_id, self._get_merge_plan(
+            cr, uid, src_partner_ids, dst_partner_id, context=context)
 
     def _update_values(self, cr, uid, src_partners, dst_partner, context=None):
         _logger.debug('_update_values for dst_partner: %s for src_partners: '
@@ -297,26 +1013,16 @@ class MergePartnerAutomatic(orm.TransientModel):
                       dst_partner.id,
                       list(map(operator.attrgetter('id'), src_partners)))
 
-        columns = dst_partner._columns
-
-        def write_serializer(column, item):
-            if isinstance(item, browse_record):
-                return item.id
-            else:
-                return item
-
-        values = dict()
-        for column, field in columns.iteritems():
-            if (field._type not in ('many2many', 'one2many') and
-                    not isinstance(field, fields.function)):
-                for item in itertools.chain(src_partners, [dst_partner]):
-                    if item[column]:
-                        values[column] = write_serializer(column,
-                                                          item[column])
-
-        values.pop('id', None)
+        plan = self._get_merge_plan(
+            cr, uid, [partner.id for partner in src_partners],
+            dst_partner.id, context=context)
+        values = dict((column, value)
+                      for column, (partner_id, value) in plan.iteritems())
         parent_id = values.pop('parent_id', None)
-        dst_partner.write(values)
+        if values:
+            # only the changed columns are written, so only the stored
+            # fields depending on them are recomputed
+            dst_partner.write(values)
         if parent_id and parent_id != dst_partner.id:
             try:
                 dst_partner.write({'parent_id': parent_id})
@@ -325,14 +1031,57 @@ class MergePartnerAutomatic(orm.TransientModel):
                              'parent_id %s of partner: %s',
                              parent_id, dst_partner.id)
 
+    def _check_merge_rights(self, cr, uid, partner_ids, src_partner_ids,
+                            context=None):
+        """Only the Administrator may merge contacts with different emails
+        or move Journal Items away from the source contacts."""
+        if openerp.SUPERUSER_ID == uid:
+            return
+        proxy = self.pool.get('res.partner')
+        if len(set(partner.email for partner
+                   in proxy.browse(cr, uid, partner_ids,
+                                   context=context))) > 1:
+            raise orm.except_orm(
+                _('Error'),
+                _("All contacts must have the same email. Only the "
+                  "Administrator can merge contacts with different emails."))
+
+        if (self._model_is_installed(
+                cr, uid, 'account.move.line', context=context) and
+                self.pool['account.move.line'].search(
+                    cr, openerp.SUPERUSER_ID,
+                    [('partner_id', 'in', src_partner_ids)],
+                    context=context)):
+            raise orm.except_orm(
+                _('Error'),
+                _("Only the destination contact may be linked to existing "
+                  "Journal Items. Please ask the Administrator if you need to"
+                  " merge several contacts linked to existing Journal "
+                  "Items."))
+
     @mute_logger('openerp.osv.expression', 'openerp.osv.orm')
-    def _merge(self, cr, uid, partner_ids, dst_partner=None, context=None):
+    def _merge(self, cr, uid, partner_ids, dst_partner=None, stats=None,
+               context=None):
+        """Merge partner_ids into dst_partner
+
+        :param stats: MergeStats the measures of the stages of the merge
+                      are added to
+        :return: stats, or a new MergeStats
+        """
         proxy = self.pool.get('res.partner')
+        if stats is None:
+            stats = MergeStats()
+
+        lock_timeout = context and context.get('merge_lock_timeout')
+        if lock_timeout and len(partner_ids) <= 3:
+            self._move_references(
+                cr, uid, [(dst_partner and dst_partner.id, partner_ids)],
+                lock_timeout, context=context)
 
         partner_ids = proxy.exists(cr, uid, list(partner_ids),
                                    context=context)
         if len(partner_ids) < 2:
-            return
+            return stats
 
         if len(partner_ids) > 3:
             raise orm.except_orm(
@@ -341,15 +1090,6 @@ class MergePartnerAutomatic(orm.TransientModel):
                   "together. You can re-open the wizard several times if "
                   "needed."))
 
-        if (openerp.SUPERUSER_ID != uid and
-                len(set(partner.email for partner
-                        in proxy.browse(cr, uid, partner_ids,
-                                        context=context))) > 1):
-            raise orm.except_orm(
-                _('Error'),
-                _("All contacts must have the same email. Only the "
-                  "Administrator can merge contacts with different emails."))
-
         if dst_partner and dst_partner.id in partner_ids:
             src_partners = proxy.browse(cr, uid,
                                         [id for id in partner_ids
@@ -362,42 +1102,315 @@ class MergePartnerAutomatic(orm.TransientModel):
             src_partners = ordered_partners[:-1]
         _logger.info("dst_partner: %s", dst_partner.id)
 
-        if (openerp.SUPERUSER_ID != uid and
-                self._model_is_installed(
-                    cr, uid, 'account.move.line', context=context) and
-                self.pool['account.move.line'].search(
-                    cr, openerp.SUPERUSER_ID,
-                    [('partner_id', 'in', [partner.id for partner
-                                           in src_partners])],
-                    context=context)):
-            raise orm.except_orm(
-                _('Error'),
-                _("Only the destination contact may be linked to existing "
-                  "Journal Items. Please ask the Administrator if you need to"
-                  " merge several contacts linked to existing Journal "
-                  "Items."))
-        self._update_foreign_keys(
-            cr, uid, src_partners, dst_partner, context=context)
-        self._update_reference_fields(
-            cr, uid, src_partners, dst_partner, context=context)
-        self._update_values(
-            cr, uid, src_partners, dst_partner, context=context)
+        self._check_merge_rights(cr, uid, partner_ids,
+                                 [partner.id for partner in src_partners],
+                                 context=context)
+        if lock_timeout:
+            cr.execute("SET LOCAL lock_timeout = %s", (lock_timeout,))
+        merge_stats = MergeStats(count_rows=stats.count_rows)
+        with merge_stats.stage(cr, 'foreign_keys'):
+            self._update_foreign_keys(
+                cr, uid, src_partners, dst_partner, context=context)
+        with merge_stats.stage(cr, 'reference_fields'):
+            self._update_reference_fields(
+                cr, uid, src_partners, dst_partner, context=context)
+        with merge_stats.stage(cr, 'values'):
+            self._update_values(
+                cr, uid, src_partners, dst_partner, context=context)
         _logger.info('(uid = %s) merged the partners %r with %s',
                      uid,
                      list(map(operator.attrgetter('id'), src_partners)),
                      dst_partner.id)
-        dst_partner.message_post(
-            body='%s %s' % (
-                _("Merged with the following partners:"),
-                ", ".join(
-                    '%s<%s>(ID %s)' % (p.name, p.email or 'n/a', p.id)
-                    for p in src_partners
+        with merge_stats.stage(cr, 'message'):
+            dst_partner.message_post(
+                body='%s %s' % (
+                    _("Merged with the following partners:"),
+                    ", ".join(
+                        '%s<%s>(ID %s)' % (p.name, p.email or 'n/a', p.id)
+                        for p in src_partners
+                    )
                 )
             )
-        )
 
-        for partner in src_partners:
-            partner.unlink()
+        with merge_stats.stage(cr, 'unlink'):
+            for partner in src_partners:
+                partner.unlink()
+        if lock_timeout:
+            cr.execute("SET LOCAL lock_timeout TO DEFAULT")
+        merge_stats.merges = 1
+        _logger.info('merge_stats %s', merge_stats.format(
+            dst_id=dst_partner.id,
+            src_ids=','.join(str(partner.id) for partner in src_partners)))
+        stats.update(merge_stats)
+        return stats
+
+    def _find_parent_cycles(self, cr, partner_ids):
+        """Return the ids among partner_ids which are their own ancestor
+
+        Only the ancestor chains of partner_ids are walked, up to
+        PARENT_MAX_DEPTH levels.
+        """
+        cr.execute("""
+            WITH RECURSIVE cycle(id, parent_id, depth) AS (
+                    SELECT id, parent_id, 1 FROM res_partner
+                    WHERE id IN %s AND parent_id IS NOT NULL
+                UNION ALL
+                    SELECT cycle.id, res_partner.parent_id, cycle.depth + 1
+                    FROM   res_partner, cycle
+                    WHERE  res_partner.id = cycle.parent_id
+                      AND  res_partner.parent_id IS NOT NULL
+                      AND  cycle.id != cycle.parent_id
+                      AND  cycle.depth < %s
+            )
+            SELECT DISTINCT id FROM cycle WHERE id = parent_id
+        """, (tuple(partner_ids), PARENT_MAX_DEPTH))
+        return [row[0] for row in cr.fetchall()]
+
+    def _create_merge_map(self, cr, groups):
+        """Fill the temporary table mapping every source partner of groups
+        to its destination partner
+
+        The table is dropped at the end of the transaction, so that a chunk
+        which failed cannot block the next one.
+        """
+        cr.execute("DROP TABLE IF EXISTS base_partner_merge_map")
+        cr.execute("""CREATE TEMPORARY TABLE base_partner_merge_map (
+                          src_id integer PRIMARY KEY,
+                          dst_id integer NOT NULL
+                      ) ON COMMIT DROP""")
+        src_ids, dst_ids = [], []
+        for dst_id, group_src_ids in groups:
+            src_ids.extend(group_src_ids)
+            dst_ids.extend([dst_id] * len(group_src_ids))
+        cr.execute("""INSERT INTO base_partner_merge_map (src_id, dst_id)
+                      SELECT unnest(%s::integer[]), unnest(%s::integer[])""",
+                   (src_ids, dst_ids))
+        cr.execute("ANALYZE base_partner_merge_map")
+
+    def _update_foreign_keys_batch(self, cr, uid, context=None):
+        """Same as _update_foreign_keys, but for all the groups stored in
+        the temporary table base_partner_merge_map at once"""
+        proxy = self.pool.get('res.partner')
+        for table, column, columns in self._get_fk_catalog(cr):
+            query_dic = {
+                'table': table,
+                'column': column,
+                'value': columns and columns[0],
+            }
+            if len(columns) == 1:
+                cr.execute("""
+                    UPDATE "%(table)s" as ___tu
+                    SET %(column)s = ___m.dst_id
+                    FROM base_partner_merge_map as ___m
+                    WHERE
+                        ___tu.%(column)s = ___m.src_id AND
+                        NOT EXISTS (
+                            SELECT 1
+                            FROM "%(table)s" as ___tw
+                            WHERE
+                                ___tw.%(column)s = ___m.dst_id AND
+                                ___tu.%(value)s = ___tw.%(value)s
+                        ) AND
+                        ___tu.%(column)s = (
+                            SELECT min(___tx.%(column)s)
+                            FROM "%(table)s" as ___tx,
+                                 base_partner_merge_map as ___mx
+                            WHERE
+                                ___tx.%(column)s = ___mx.src_id AND
+                                ___mx.dst_id = ___m.dst_id AND
+                                ___tu.%(value)s = ___tx.%(value)s
+                        )""" % query_dic)
+                continue
+
+            query = """
+                UPDATE "%(table)s" as ___tu
+                SET %(column)s = ___m.dst_id
+                FROM base_partner_merge_map as ___m
+                WHERE ___tu.%(column)s = ___m.src_id""" % query_dic
+            if not (column == proxy._parent_name and table == 'res_partner'):
+                cr.execute(query)
+                continue
+
+            # skip the groups for which the new parents would make a cycle
+            cr.execute("SAVEPOINT recursive_partner_savepoint")
+            try:
+                cr.execute(query)
+                cr.execute("SELECT DISTINCT dst_id "
+                           "FROM base_partner_merge_map")
+                cycle_ids = self._find_parent_cycles(
+                    cr, [row[0] for row in cr.fetchall()])
+                if cycle_ids:
+                    cr.execute("ROLLBACK TO SAVEPOINT "
+                               "recursive_partner_savepoint")
+                    cr.execute(query + " AND ___m.dst_id NOT IN %s",
+                               (tuple(cycle_ids),))
+            finally:
+                cr.execute("RELEASE SAVEPOINT recursive_partner_savepoint")
+
+    def _update_reference_fields_batch(self, cr, uid, context=None):
+        """Same as _update_reference_fields, but for all the groups stored
+        in the temporary table base_partner_merge_map at once"""
+        model_targets, reference_targets = self._get_reference_targets(cr)
+
+        updated = []
+        for model, table, condition, field_id, unique in model_targets:
+            query = """
+                UPDATE "%(table)s" as ___tu
+                SET %(field_id)s = ___m.dst_id
+                FROM base_partner_merge_map as ___m
+                WHERE %(condition)s AND ___tu.%(field_id)s = ___m.src_id"""
+            if unique:
+                query += """ AND
+                    NOT EXISTS (
+                        SELECT 1
+                        FROM "%(table)s" as ___tw
+                        WHERE
+                            %(condition)s AND
+                            ___tw.%(field_id)s = ___m.dst_id AND
+                            ___tw.%(unique)s = ___tu.%(unique)s
+                    ) AND
+                    ___tu.%(field_id)s = (
+                        SELECT min(___tx.%(field_id)s)
+                        FROM "%(table)s" as ___tx,
+                             base_partner_merge_map as ___mx
+                        WHERE
+                            %(condition)s AND
+                            ___tx.%(field_id)s = ___mx.src_id AND
+                            ___mx.dst_id = ___m.dst_id AND
+                            ___tx.%(unique)s = ___tu.%(unique)s
+                    )"""
+            cr.execute(query % {
+                'table': table,
+                'condition': condition,
+                'field_id': field_id,
+                'unique': unique,
+            })
+            if cr.rowcount:
+                updated.append((model, field_id))
+
+        for model, table, column in reference_targets:
+            cr.execute("""
+                UPDATE "%(table)s"
+                SET %(column)s = 'res.partner,' || ___m.dst_id
+                FROM base_partner_merge_map as ___m
+                WHERE %(column)s = 'res.partner,' || ___m.src_id""" % {
+                'table': table,
+                'column': column,
+            })
+            if cr.rowcount:
+                updated.append((model, column))
+
+        self._invalidate_reference_caches(cr, uid, updated, context=context)
+
+    def _check_merge_groups(self, cr, uid, groups, context=None):
+        """Return groups without missing partners and empty groups
+
+        :raise: except_orm if a partner is part of several groups
+        """
+        proxy = self.pool.get('res.partner')
+        groups = [
+            (int(dst_id), [int(i) for i in src_ids if int(i) != int(dst_id)])
+            for dst_id, src_ids in groups
+        ]
+        all_ids = [i for dst_id, src_ids in groups
+                   for i in [dst_id] + src_ids]
+        if len(all_ids) != len(set(all_ids)):
+            raise orm.except_orm(
+                _('Error'),
+                _("A contact cannot be part of several groups to merge."))
+
+        existing_ids = set(proxy.exists(cr, uid, all_ids, context=context))
+        result = []
+        for dst_id, src_ids in groups:
+            src_ids = [i for i in src_ids if i in existing_ids]
+            if dst_id in existing_ids and src_ids:
+                result.append((dst_id, src_ids))
+        return result
+
+    @mute_logger('openerp.osv.expression', 'openerp.osv.orm')
+    def merge_groups(self, cr, uid, groups, chunk_size=BATCH_CHUNK_SIZE,
+                     commit=True, stats=None, context=None):
+        """Merge many groups of partners, without limit on the group size.
+
+        The foreign keys and reference fields of all the groups of a chunk
+        are rewritten with one statement per table, joined on a temporary
+        src -> dst mapping table. With merge_lock_timeout in the context,
+        they are first moved by _move_references when the chunk starts a
+        new transaction.
+
+        :param groups: list of (dst_id, [src_ids]) tuples
+        :param chunk_size: number of groups merged per transaction
+        :param commit: commit the cursor after each chunk
+        :param stats: MergeStats the measures of the stages of the merged
+                      chunks are added to
+        :return: the number of merged groups
+        """
+        context = dict(context or {}, active_test=False)
+        proxy = self.pool.get('res.partner')
+        lock_timeout = context.get('merge_lock_timeout')
+        groups = self._check_merge_groups(cr, uid, groups, context=context)
+        total = len(groups)
+        _logger.info('merge_groups: %s groups to merge', total)
+
+        for start in xrange(0, total, chunk_size):
+            chunk = groups[start:start + chunk_size]
+            if lock_timeout:
+                if commit:
+                    cr.commit()
+                self._move_references(
+                    cr, uid, [(dst_id, [dst_id] + src_ids)
+                              for dst_id, src_ids in chunk],
+                    lock_timeout, context=context)
+                cr.execute("SET LOCAL lock_timeout = %s", (lock_timeout,))
+            for dst_id, src_ids in chunk:
+                self._check_merge_rights(cr, uid, [dst_id] + src_ids,
+                                         src_ids, context=context)
+
+            merge_stats = MergeStats(
+                count_rows=stats is not None and stats.count_rows)
+            self._create_merge_map(cr, chunk)
+            with merge_stats.stage(cr, 'foreign_keys'):
+                self._update_foreign_keys_batch(cr, uid, context=context)
+            with merge_stats.stage(cr, 'reference_fields'):
+                self._update_reference_fields_batch(cr, uid,
+                                                    context=context)
+            cr.execute("DROP TABLE base_partner_merge_map")
+
+            partners = [(proxy.browse(cr, uid, dst_id, context=context),
+                         proxy.browse(cr, uid, src_ids, context=context))
+                        for dst_id, src_ids in chunk]
+            with merge_stats.stage(cr, 'values'):
+                for dst_partner, src_partners in partners:
+                    self._update_values(
+                        cr, uid, src_partners, dst_partner, context=context)
+            with merge_stats.stage(cr, 'message'):
+                for dst_partner, src_partners in partners:
+                    dst_partner.message_post(
+                        body='%s %s' % (
+                            _("Merged with the following partners:"),
+                            ", ".join(
+                                '%s<%s>(ID %s)' % (p.name, p.email or 'n/a',
+                                                   p.id)
+                                for p in src_partners
+                            )
+                        )
+                    )
+            with merge_stats.stage(cr, 'unlink'):
+                proxy.unlink(cr, uid,
+                             [i for dummy, src_ids in chunk for i in src_ids],
+                             context=context)
+            if lock_timeout:
+                cr.execute("SET LOCAL lock_timeout TO DEFAULT")
+            merge_stats.merges = len(chunk)
+            if stats is not None:
+                stats.update(merge_stats)
+
+            if commit:
+                cr.commit()
+            done = min(start + chunk_size, total)
+            _logger.info('merge_groups: %s/%s groups merged (%.1f%%)',
+                         done, total, done * 100.0 / total)
+        return total
 
     def clean_emails(self, cr, uid, context=None):
         """
@@ -405,9 +1418,12 @@ class MergePartnerAutomatic(orm.TransientModel):
         with a minimum of two addresses, the system will create a new partner,
         with the information of the previous one and will copy the new cleaned
         email into the email field.
+
+        Only the emails with a separator or uppercase letters are considered.
+        They are read through a server side cursor, and the cleaned emails
+        are written with one UPDATE per chunk.
         """
-        if context is None:
-            context = {}
+        context = dict(context or {}, active_test=False)
 
         proxy_model = self.pool['ir.model.fields']
         field_ids = proxy_model.search(cr, uid,
@@ -418,69 +1434,84 @@ class MergePartnerAutomatic(orm.TransientModel):
         reset_fields = dict((field['name'], []) for field in fields)
 
         proxy_partner = self.pool['res.partner']
-        context['active_test'] = False
-        ids = proxy_partner.search(cr, uid, [], context=context)
-
-        fields = ['name', 'var' 'partner_id' 'is_company', 'email']
-        partners = proxy_partner.read(cr, uid, ids, fields, context=context)
-
-        partners.sort(key=operator.itemgetter('id'))
-        partners_len = len(partners)
-
-        _logger.info('partner_len: %r', partners_len)
-
-        for idx, partner in enumerate(partners):
-            if not partner['email']:
-                continue
-
-            percent = (idx / float(partners_len)) * 100.0
-            _logger.info('idx: %r', idx)
-            _logger.info('percent: %r', percent)
-            try:
-                emails = sanitize_email(partner['email'])
+        counter = 0
+        for partners in fetch_chunks(
+                cr, 'base_partner_merge_clean_emails',
+                r"""SELECT id, email FROM res_partner
+                     WHERE email ~ '[,;:/<>&[:space:]]'
+                        OR email <> lower(email)
+                  ORDER BY id""", size=CLEAN_CHUNK_SIZE):
+            values = []
+            copies = []
+            sanitized = sanitize_emails(email for dummy, email in partners)
+            for (partner_id, partner_email), emails in zip(partners,
+                                                           sanitized):
                 head, tail = emails[:1], emails[1:]
-                email = head[0] if head else False
-
-                proxy_partner.write(cr, uid, [partner['id']],
-                                    {'email': email}, context=context)
-
-                for email in tail:
-                    values = dict(reset_fields, email=email)
-                    proxy_partner.copy(cr, uid, partner['id'], values,
-                                       context=context)
+                email = head[0] if head else None
+                if email != partner_email:
+                    values.extend([partner_id, email])
+                copies.extend((partner_id, email) for email in tail)
+
+            if values:
+                cr.execute("""
+                    UPDATE res_partner as p
+                    SET email = v.email,
+                        write_uid = %s,
+                        write_date = now() at time zone 'UTC'
+                    FROM (VALUES """ +
+                           ', '.join(['(%s, %s)'] * (len(values) / 2)) +
+                           """) as v(id, email)
+                    WHERE p.id = v.id""", [uid] + values)
+                proxy_partner._update_email_columns(cr, values[::2])
+                proxy_partner.invalidate_cache(
+                    cr, uid, ['email'] + EMAIL_COLUMNS,
+                    values[::2], context=context)
+
+            for partner_id, email in copies:
+                proxy_partner.copy(cr, uid, partner_id,
+                                   dict(reset_fields, email=email),
+                                   context=context)
 
-            except Exception:
-                _logger.exception("There is a problem with this partner: %r",
-                                  partner)
-                raise
+            counter += len(partners)
+            _logger.info('clean_emails: %s partners processed', counter)
         return True
 
     def close_cb(self, cr, uid, ids, context=None):
         return {'type': 'ir.actions.act_window_close'}
 
     def _generate_query(self, fields, maximum_group=100):
-        group_fields = ', '.join(fields)
+        """Group the partners on their keys in base.partner.merge.key, the
+        normalized email, is_company and parent_id are taken from
+        res_partner"""
+        columns = dict(
+            (field, 'k.%s' % field if field in MERGE_KEY_FIELDS else
+             'p.email_normalized' if field == 'email' else 'p.%s' % field)
+            for field in fields)
+        group_fields = ', '.join(columns[field] for field in fields)
 
         filters = []
         for field in fields:
             if field in ['email', 'name']:
-                filters.append((field, 'IS NOT', 'NULL'))
+                filters.append((columns[field], 'IS NOT', 'NULL'))
 
         criteria = ' AND '.join('%s %s %s' % (field, operator, value)
                                 for field, operator, value in filters)
 
         text = [
-            "SELECT min(id), array_agg(id)",
-            "FROM res_partner",
+            "SELECT min(k.partner_id), array_agg(k.partner_id)",
+            "FROM base_partner_merge_key as k",
         ]
 
+        if not set(fields).issubset(MERGE_KEY_FIELDS):
+            text.append("JOIN res_partner as p ON p.id = k.partner_id")
+
         if criteria:
             text.append('WHERE %s' % criteria)
 
         text.extend([
             "GROUP BY %s" % group_fields,
             "HAVING COUNT(*) >= 2",
-            "ORDER BY min(id)",
+            "ORDER BY min(k.partner_id)",
         ])
 
         if maximum_group:
@@ -545,7 +1576,9 @@ class MergePartnerAutomatic(orm.TransientModel):
         if this.line_ids:
             # in this case, we try to find the next record.
             current_line = this.line_ids[0]
-            current_partner_ids = literal_eval(current_line.aggr_ids)
+            current_partner_ids = self.pool['base.partner.merge.line'].\
+                get_aggr_ids(cr, uid, [current_line.id],
+                             context=context)[current_line.id]
             values.update({
                 'current_line_id': current_line.id,
                 'partner_ids': [(6, 0, current_partner_ids)],
@@ -578,17 +1611,27 @@ class MergePartnerAutomatic(orm.TransientModel):
         domain = [('model', '=', model)]
         return proxy.search_count(cr, uid, domain, context=context) > 0
 
-    def _partner_use_in(self, cr, uid, aggr_ids, models, context=None):
+    def _exclude_lines(self, cr, uid, ids, models, context=None):
         """
-        Check if there is no occurence of this group of partner in the selected
-        model
+        Remove the lines of this wizard having at least one partner used in
+        the selected models, with one anti-join per model
         """
+        excluded = 0
         for model, field in models.iteritems():
-            proxy = self.pool.get(model)
-            domain = [(field, 'in', aggr_ids)]
-            if proxy.search_count(cr, uid, domain, context=context):
-                return True
-        return False
+            cr.execute("""
+                DELETE FROM base_partner_merge_line
+                WHERE id IN (
+                    SELECT line.id
+                    FROM base_partner_merge_line as line,
+                         unnest(line.aggr_ids) as partner(id)
+                    WHERE line.wizard_id = %%s AND EXISTS (
+                        SELECT 1 FROM "%(table)s" as model
+                        WHERE model.%(field)s = partner.id))""" % {
+                'table': self.pool[model]._table,
+                'field': field,
+            }, (ids[0],))
+            excluded += cr.rowcount
+        return excluded
 
     def compute_models(self, cr, uid, ids, context=None):
         """
@@ -614,24 +1657,70 @@ class MergePartnerAutomatic(orm.TransientModel):
         """
         Execute the select request and write the result in this wizard
         """
-        proxy = self.pool.get('base.partner.merge.line')
+        cr.execute("""
+            INSERT INTO base_partner_merge_line
+                (wizard_id, min_id, aggr_ids, create_uid, create_date,
+                 write_uid, write_date)
+            SELECT %s, min_id, aggr_ids, %s, now() at time zone 'UTC',
+                   %s, now() at time zone 'UTC'
+            FROM (""" + query + """) as groups(min_id, aggr_ids)""",
+                   (ids[0], uid, uid))
+        self._process_lines(cr, uid, ids, context=context)
+
+    def _fuzzy_groups(self, cr, uid, this, context=None):
+        """Return the (min_id, aggr_ids) groups of similar partners"""
+        groups = []
+        partners = (row
+                    for rows in fetch_chunks(
+                        cr, 'base_partner_merge_fuzzy',
+                        "SELECT id, name, email, zip FROM res_partner "
+                        "WHERE name IS NOT NULL")
+                    for row in rows)
+        for partner_ids in find_duplicate_groups(
+                partners, threshold=this.fuzzy_threshold):
+            groups.append((partner_ids[0], partner_ids))
+        _logger.info('fuzzy matching found %s groups', len(groups))
+        if this.maximum_group:
+            groups = groups[:this.maximum_group]
+        return groups
+
+    def _process_groups(self, cr, uid, ids, groups, context=None):
+        """
+        Write the (min_id, aggr_ids) groups in this wizard
+        """
+        for start in xrange(0, len(groups), LINE_CHUNK_SIZE):
+            chunk = groups[start:start + LINE_CHUNK_SIZE]
+            cr.execute("""
+                INSERT INTO base_partner_merge_line
+                    (wizard_id, min_id, aggr_ids, create_uid, create_date,
+                     write_uid, write_date)
+                SELECT %s, min_id, aggr_ids, %s, now() at time zone 'UTC',
+                       %s, now() at time zone 'UTC'
+                FROM (VALUES """ +
+                       ', '.join(['(%s, %s::integer[])'] * len(chunk)) +
+                       """) as groups(min_id, aggr_ids)""",
+                       [ids[0], uid, uid] + [item for group in chunk
+                                             for item in group])
+        self._process_lines(cr, uid, ids, context=context)
+
+    def _get_lines(self, cr, uid, ids, context=None):
+        """Return the (line id, partner ids) of the lines of this wizard"""
+        cr.execute("SELECT id, aggr_ids FROM base_partner_merge_line "
+                   "WHERE wizard_id = %s ORDER BY min_id", (ids[0],))
+        return cr.fetchall()
+
+    def _process_lines(self, cr, uid, ids, context=None):
+        """
+        Remove the lines using an excluded model and count the others
+        """
         this = self.browse(cr, uid, ids[0], context=context)
         models = self.compute_models(cr, uid, ids, context=context)
-        cr.execute(query)
-
-        counter = 0
-        for min_id, aggr_ids in cr.fetchall():
-            if models and self._partner_use_in(cr, uid, aggr_ids, models,
-                                               context=context):
-                continue
-            values = {
-                'wizard_id': this.id,
-                'min_id': min_id,
-                'aggr_ids': aggr_ids,
-            }
+        if models:
+            self._exclude_lines(cr, uid, ids, models, context=context)
 
-            proxy.create(cr, uid, values, context=context)
-            counter += 1
+        cr.execute("SELECT count(*) FROM base_partner_merge_line "
+                   "WHERE wizard_id = %s", (ids[0],))
+        counter = cr.fetchone()[0]
 
         values = {
             'state': 'selection',
@@ -653,23 +1742,165 @@ class MergePartnerAutomatic(orm.TransientModel):
 
         context = dict(context or {}, active_test=False)
         this = self.browse(cr, uid, ids[0], context=context)
-        groups = self._compute_selected_groupby(this)
-        query = self._generate_query(groups, this.maximum_group)
-        self._process_query(cr, uid, ids, query, context=context)
+        if this.fuzzy_match:
+            groups = self._fuzzy_groups(cr, uid, this, context=context)
+            self._process_groups(cr, uid, ids, groups, context=context)
+        else:
+            groups = self._compute_selected_groupby(this)
+            query = self._generate_query(groups, this.maximum_group)
+            self._process_query(cr, uid, ids, query, context=context)
 
         return self._next_screen(cr, uid, this, context)
 
+    def _get_query_description(self, this):
+        """Describe how the candidate groups of this wizard are found"""
+        if this.fuzzy_match:
+            return 'fuzzy matching, threshold %s' % this.fuzzy_threshold
+        query = self._generate_query(self._compute_selected_groupby(this),
+                                     this.maximum_group)
+        models = self.compute_models(this._cr, this._uid, [this.id],
+                                     context=this._context)
+        if models:
+            query += ' -- excluding contacts used in %s' % ', '.join(models)
+        return query
+
+    def create_job_cb(self, cr, uid, ids, context=None):
+        """
+        Compute the groups like start_process_cb, and save them in a merge
+        job run in background by the cron
+        """
+        assert is_integer_list(ids)
+        context = dict(context or {}, active_test=False)
+        this = self.browse(cr, uid, ids[0], context=context)
+        query = self._get_query_description(this)
+        self.start_process_cb(cr, uid, ids, context=context)
+        job_id = self.pool['base.partner.merge.job'].create_from_wizard(
+            cr, uid, this.id, query, context=context)
+        return {
+            'type': 'ir.actions.act_window',
+            'res_model': 'base.partner.merge.job',
+            'res_id': job_id,
+            'view_mode': 'form',
+        }
+
+    def _get_merge_context(self, this, context=None):
+        """Context of the merges of this wizard"""
+        if this.lock_timeout:
+            context = dict(context or {},
+                           merge_lock_timeout=this.lock_timeout)
+        return context
+
+    def _merge_lines(self, cr, uid, ids, context=None):
+        """Merge the lines of this wizard, committing after each line, and
+        save the statistics of the merges in the wizard"""
+        this = self.browse(cr, uid, ids[0], context=context)
+        context = self._get_merge_context(this, context=context)
+        lines = self._get_lines(cr, uid, ids, context=context)
+        stats = MergeStats()
+        # every merge starts a new transaction
+        cr.commit()
+        if this.merge_workers > 1 and len(lines) > 1:
+            self._merge_lines_parallel(cr, uid, lines, this.merge_workers,
+                                       stats, context=context)
+        else:
+            for line_id, partner_ids in lines:
+                self._merge_line_retry(cr, uid, line_id, partner_ids,
+                                       stats=stats, context=context)
+        _logger.info('merge_stats %s', stats.format(wizard_id=this.id))
+        this.write({'merge_stats': stats.report()})
+
+    def _get_ancestors(self, cr, partner_ids):
+        """Return a dictionary {partner id: ids of its ancestors}"""
+        cr.execute("""
+            WITH RECURSIVE ancestor(id, parent_id) AS (
+                    SELECT id, parent_id FROM res_partner
+                    WHERE id = ANY(%s) AND parent_id IS NOT NULL
+                UNION
+                    SELECT ancestor.id, res_partner.parent_id
+                    FROM   res_partner, ancestor
+                    WHERE  res_partner.id = ancestor.parent_id
+                      AND  res_partner.parent_id IS NOT NULL
+            )
+            SELECT id, array_agg(parent_id) FROM ancestor GROUP BY id
+        """, (list(partner_ids),))
+        return dict(cr.fetchall())
+
+    def _merge_lines_parallel(self, cr, uid, lines, workers, stats,
+                              context=None):
+        """Merge the (line id, partner ids) lines in independent partitions,
+        each one in its own thread and cursor, adding the measures of the
+        merges to the MergeStats stats"""
+        ancestors = self._get_ancestors(
+            cr, set(itertools.chain.from_iterable(
+                partner_ids for dummy, partner_ids in lines)))
+        partitions = partition_groups(lines, ancestors, workers)
+        _logger.info('merging %s groups in %s partitions',
+                     len(lines), len(partitions))
+
+        errors = []
+        partition_stats = [MergeStats() for partition in partitions]
+        threads = [
+            threading.Thread(target=self._merge_partition,
+                             args=(cr.dbname, uid, partition, errors),
+                             kwargs={'stats': partition_stat,
+                                     'context': context})
+            for partition, partition_stat in zip(partitions, partition_stats)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for partition_stat in partition_stats:
+            stats.update(partition_stat)
+        if errors:
+            raise errors[0]
+
+    def _merge_partition(self, dbname, uid, lines, errors, stats=None,
+                         context=None):
+        """Merge lines in a new cursor, retrying the lines failing because
+        of a concurrent transaction. The exception stopping the partition
+        is appended to errors."""
+        try:
+            with api.Environment.manage():
+                registry = openerp.registry(dbname)
+                with closing(registry.cursor()) as cr:
+                    for line_id, partner_ids in lines:
+                        self._merge_line_retry(cr, uid, line_id, partner_ids,
+                                               stats=stats, context=context)
+        except Exception as e:
+            _logger.exception('parallel merge failed')
+            errors.append(e)
+
+    def _merge_line_retry(self, cr, uid, line_id, partner_ids, stats=None,
+                          context=None):
+        for tries in itertools.count(1):
+            try:
+                # measures of the rolled back tries are dropped
+                merge_stats = self._merge(cr, uid, partner_ids,
+                                          context=context)
+                cr.execute("DELETE FROM base_partner_merge_line "
+                           "WHERE id = %s", (line_id,))
+                cr.commit()
+                if stats is not None:
+                    stats.update(merge_stats)
+                return
+            except OperationalError as e:
+                cr.rollback()
+                if (e.pgcode not in PG_CONCURRENCY_ERRORS_TO_RETRY or
+                        tries >= MAX_TRIES_ON_CONCURRENCY_FAILURE):
+                    raise
+                wait_time = random.uniform(0.0, 2 ** tries)
+                _logger.info('%s, retry merge of %r in %.04f sec...',
+                             e.pgcode, partner_ids, wait_time)
+                time.sleep(wait_time)
+
     def automatic_process_cb(self, cr, uid, ids, context=None):
         assert is_integer_list(ids)
         this = self.browse(cr, uid, ids[0], context=context)
         this.start_process_cb()
         this.refresh()
 
-        for line in this.line_ids:
-            partner_ids = literal_eval(line.aggr_ids)
-            self._merge(cr, uid, partner_ids, context=context)
-            line.unlink()
-            cr.commit()
+        self._merge_lines(cr, uid, ids, context=context)
 
         this.write({'state': 'finished'})
         return {
@@ -695,13 +1926,13 @@ class MergePartnerAutomatic(orm.TransientModel):
             INNER join
                 res_partner as p2
             ON
-                p1.email = p2.email AND
+                p1.email_normalized = p2.email_normalized AND
                 p1.name = p2.name AND
                 (p1.parent_id = p2.id OR p1.id = p2.parent_id)
             WHERE
                 p2.id IS NOT NULL
             GROUP BY
-                p1.email,
+                p1.email_normalized,
                 p1.name,
                 CASE WHEN p1.parent_id = p2.id THEN p2.id
                     ELSE p1.id
@@ -713,11 +1944,7 @@ class MergePartnerAutomatic(orm.TransientModel):
 
         self._process_query(cr, uid, ids, query, context=context)
 
-        for line in this.line_ids:
-            partner_ids = literal_eval(line.aggr_ids)
-            self._merge(cr, uid, partner_ids, context=context)
-            line.unlink()
-            cr.commit()
+        self._merge_lines(cr, uid, ids, context=context)
 
         this.write({'state': 'finished'})
 
@@ -835,61 +2062,103 @@ class MergePartnerAutomatic(orm.TransientModel):
                 'target': 'new',
             }
 
-        self._merge(cr, uid, partner_ids, this.dst_partner_id,
-                    context=context)
+        stats = self._merge(
+            cr, uid, partner_ids, this.dst_partner_id,
+            context=self._get_merge_context(this, context=context))
+        this.write({'merge_stats': stats.report()})
 
         if this.current_line_id:
             this.current_line_id.unlink()
 
         return self._next_screen(cr, uid, this, context)
 
+    def _compute_parent_assignments(self, cr):
+        """Fill the temporary table base_partner_merge_parent with the
+        partners to attach to a parent company by auto_set_parent_id
+
+        The partners having a grade are the candidate companies of their
+        email domain, the one with the most open or paid invoices wins.
+        Domains where more than one other partner has invoices are
+        skipped.
+        """
+        cr.execute("DROP TABLE IF EXISTS base_partner_merge_domain")
+        cr.execute("""
+            CREATE TEMPORARY TABLE base_partner_merge_domain AS
+            SELECT p.id AS partner_id,
+                   p.email_domain AS domain,
+                   p.grade_id IS NOT NULL AS graded,
+                   coalesce(a.invoice_count, 0) AS invoice_count
+            FROM res_partner p
+            LEFT JOIN (SELECT partner_id, count(*) AS invoice_count
+                       FROM account_invoice
+                       WHERE state IN ('open', 'paid')
+                       GROUP BY partner_id) a ON a.partner_id = p.id
+            WHERE p.email_domain IS NOT NULL
+              AND p.email_domain NOT IN %s
+        """, (PARENT_EXCLUDED_DOMAINS,))
+        cr.execute("CREATE INDEX ON base_partner_merge_domain (domain)")
+        cr.execute("ANALYZE base_partner_merge_domain")
+
+        cr.execute("DROP TABLE IF EXISTS base_partner_merge_parent")
+        cr.execute("""
+            CREATE TEMPORARY TABLE base_partner_merge_parent AS
+            WITH candidate AS (
+                SELECT DISTINCT ON (domain)
+                       domain, partner_id AS parent_id, invoice_count,
+                       sum(CASE WHEN invoice_count > 0 THEN 1 ELSE 0 END)
+                           OVER (PARTITION BY domain) AS invoiced_count
+                FROM base_partner_merge_domain
+                WHERE domain IN (SELECT domain
+                                 FROM base_partner_merge_domain
+                                 WHERE graded)
+                ORDER BY domain, graded DESC, invoice_count DESC, partner_id
+            )
+            SELECT d.partner_id AS child_id, c.parent_id, c.domain
+            FROM candidate c
+            JOIN base_partner_merge_domain d ON d.domain = c.domain
+            JOIN res_partner p ON p.id = d.partner_id
+            WHERE d.partner_id != c.parent_id
+              AND p.parent_id IS DISTINCT FROM c.parent_id
+              AND c.invoiced_count -
+                  CASE WHEN c.invoice_count > 0 THEN 1 ELSE 0 END <= 1
+        """)
+        cr.execute("DROP TABLE base_partner_merge_domain")
+
     def auto_set_parent_id(self, cr, uid, ids, context=None):
-        assert is_integer_list(ids)
+        """Attach the partners to the company sharing their email domain
 
-        # select partner who have one least invoice
-        partner_treated = ['@gmail.com']
-        cr.execute("""  SELECT p.id, p.email
-                        FROM res_partner as p
-                        LEFT JOIN account_invoice as a
-                        ON p.id = a.partner_id AND a.state in ('open','paid')
-                        WHERE p.grade_id is NOT NULL
-                        GROUP BY p.id
-                        ORDER BY COUNT(a.id) DESC
-                """)
-        re_email = re.compile(r".*@")
-        for id, email in cr.fetchall():
-            # check email domain
-            email = re_email.sub("@", email or "")
-            if not email or email in partner_treated:
-                continue
-            partner_treated.append(email)
+        With dry_run in the context, nothing is updated and the report of
+        the changes is returned as a list of (domain, parent id, child
+        ids).
+        """
+        assert is_integer_list(ids)
+        if context is None:
+            context = {}
 
-            # don't update the partners if they are more of one who have
-            # invoice
+        self._compute_parent_assignments(cr)
+        cr.execute("""SELECT domain, parent_id, array_agg(child_id)
+                        FROM base_partner_merge_parent
+                    GROUP BY domain, parent_id
+                    ORDER BY domain""")
+        report = cr.fetchall()
+        for domain, parent_id, child_ids in report:
+            _logger.info('auto_set_parent_id: %s partners of %s attached to '
+                         '%s', len(child_ids), domain, parent_id)
+        if context.get('dry_run'):
+            cr.execute("DROP TABLE base_partner_merge_parent")
+            return report
+
+        child_ids = [child_id for _domain, _parent_id, domain_child_ids
+                     in report for child_id in domain_child_ids]
+        child_ids.sort()
+        for start in xrange(0, len(child_ids), PARENT_CHUNK_SIZE):
             cr.execute("""
-                SELECT *
-                    FROM res_partner as p
-                        WHERE p.id != %s AND p.email LIKE '%%%s' AND
-                           EXISTS (SELECT * FROM account_invoice as a
-                                   WHERE p.id = a.partner_id
-                                       AND a.state in ('open','paid'))
-                    """ % (id, email))
-
-            if len(cr.fetchall()) > 1:
-                _logger.info("%s MORE OF ONE COMPANY", email)
-                continue
-
-            # to display changed values
-            cr.execute("""  SELECT id,email
-                            FROM res_partner
-                            WHERE parent_id != %s
-                                AND id != %s AND email LIKE '%%%s'
-                    """ % (id, id, email))
-            _logger.info("%r", cr.fetchall())
-
-            # upgrade
-            cr.execute("""  UPDATE res_partner
-                            SET parent_id = %s
-                            WHERE id != %s AND email LIKE '%%%s'
-                    """ % (id, id, email))
+                UPDATE res_partner p
+                   SET parent_id = m.parent_id
+                  FROM base_partner_merge_parent m
+                 WHERE p.id = m.child_id AND m.child_id IN %s
+            """, (tuple(child_ids[start:start + PARENT_CHUNK_SIZE]),))
+        cr.execute("DROP TABLE base_partner_merge_parent")
+        self.pool['res.partner'].invalidate_cache(
+            cr, uid, ['parent_id'], child_ids, context=context)
         return False
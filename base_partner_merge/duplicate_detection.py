@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Fuzzy detection of duplicated partners.
+
+Comparing every partner with every other one is not an option on large
+databases, so the partners are first put in blocks sharing a cheap key
+(phonetic key of the name, name prefix, email domain or zip). Inside a
+block, the partners are sorted by name and each of them is only compared
+with the following ones in a window of fixed size. The number of
+comparisons is then linear in the number of partners.
+"""
+
+import re
+import unicodedata
+
+# letters not listed are ignored
+SOUNDEX_CODES = dict(
+    [(letter, '1') for letter in 'bfpv'] +
+    [(letter, '2') for letter in 'cgjkqsxz'] +
+    [(letter, '3') for letter in 'dt'] +
+    [('l', '4')] +
+    [(letter, '5') for letter in 'mn'] +
+    [('r', '6')]
+)
+
+NAME_PREFIX_SIZE = 5
+
+re_punctuation = re.compile(r'[^\w\s]+', re.UNICODE)
+
+
+def name_tokens(name):
+    """Return the lowercased words of name, without accents nor
+    punctuation, so 'ACME S.A.' and 'Acme SA' give the same tokens"""
+    if not isinstance(name, unicode):
+        name = (name or '').decode('utf-8')
+    name = unicodedata.normalize('NFKD', name.lower())
+    name = u''.join(char for char in name
+                    if not unicodedata.combining(char))
+    return re_punctuation.sub(u'', name).split()
+
+
+def name_key(name):
+    """Sorted tokens of name, so transposed first and last names match"""
+    return u' '.join(sorted(name_tokens(name)))
+
+
+def soundex(word):
+    """Return the american soundex of word, e.g. soundex('robert') is
+    'r163'"""
+    if not word:
+        return ''
+    result = [word[0]]
+    last = SOUNDEX_CODES.get(word[0])
+    for char in word[1:]:
+        code = SOUNDEX_CODES.get(char)
+        if code and code != last:
+            result.append(code)
+        if char not in 'hw':
+            last = code
+    return ''.join(result)[:4].ljust(4, '0')
+
+
+def trigrams(text):
+    text = u'  %s ' % text
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+def similarity(trigrams1, trigrams2):
+    """Jaccard index of two sets of trigrams"""
+    if not trigrams1 or not trigrams2:
+        return 0.0
+    common = len(trigrams1 & trigrams2)
+    return float(common) / (len(trigrams1) + len(trigrams2) - common)
+
+
+def blocking_keys(key, email, zip_code):
+    """Return the keys of the blocks a partner belongs to"""
+    keys = []
+    if key:
+        keys.append('p:' + ' '.join(sorted(soundex(token)
+                                           for token in key.split())))
+        keys.append('n:' + key.replace(u' ', u'')[:NAME_PREFIX_SIZE])
+    if email and '@' in email:
+        keys.append('d:' + email.rsplit('@', 1)[1].strip().lower())
+    if zip_code:
+        keys.append('z:' + zip_code.replace(' ', '').upper())
+    return keys
+
+
+class UnionFind(object):
+
+    def __init__(self):
+        self.parents = {}
+
+    def find(self, item):
+        root = self.parents.setdefault(item, item)
+        while self.parents[root] != root:
+            root = self.parents[root]
+        while item != root:
+            item, self.parents[item] = self.parents[item], root
+        return root
+
+    def union(self, item1, item2):
+        root1, root2 = self.find(item1), self.find(item2)
+        if root1 != root2:
+            self.parents[max(root1, root2)] = min(root1, root2)
+
+    def groups(self):
+        result = {}
+        for item in self.parents:
+            result.setdefault(self.find(item), []).append(item)
+        return [sorted(items) for items in result.itervalues()
+                if len(items) > 1]
+
+
+def find_duplicate_groups(partners, threshold=0.8, window=20):
+    """Group the similar partners
+
+    :param partners: iterable of (id, name, email, zip) tuples
+    :param threshold: minimal similarity of the names of two partners
+                      for them to be duplicates
+    :param window: number of following partners in a block each partner
+                   is compared with
+    :return: list of sorted lists of partner ids, ordered by lowest id
+    """
+    keys = {}
+    emails = {}
+    blocks = {}
+    for partner_id, name, email, zip_code in partners:
+        key = name_key(name)
+        keys[partner_id] = key
+        if email:
+            emails[partner_id] = email.strip().lower()
+        for block_key in blocking_keys(key, email, zip_code):
+            blocks.setdefault(block_key, []).append(partner_id)
+
+    union_find = UnionFind()
+    for partner_ids in blocks.itervalues():
+        if len(partner_ids) < 2:
+            continue
+        partner_ids.sort(key=keys.get)
+        block_trigrams = [trigrams(keys[partner_id])
+                          for partner_id in partner_ids]
+        for index, partner_id in enumerate(partner_ids):
+            candidates = partner_ids[index + 1:index + 1 + window]
+            scores = [
+                similarity(block_trigrams[index], other_trigrams)
+                for other_trigrams
+                in block_trigrams[index + 1:index + 1 + window]
+            ]
+            email = emails.get(partner_id)
+            for other_id, score in zip(candidates, scores):
+                if score >= threshold or (
+                        email and email == emails.get(other_id)):
+                    union_find.union(partner_id, other_id)
+
+    return sorted(union_find.groups())
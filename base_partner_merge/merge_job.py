@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+
+import logging
+import time
+
+from openerp import tools
+from openerp.osv import orm
+from openerp.osv import fields
+from openerp.tools.translate import _
+
+from .base_partner_merge import add_aggr_ids_column
+from .merge_stats import MERGE_STAGES, MergeStats
+
+_logger = logging.getLogger('base.partner.merge')
+
+# number of groups merged between two checkpoints of a job
+JOB_CHUNK_SIZE = 100
+
+# first key of the advisory locks taken while running a job
+JOB_LOCK_KEY = 0x6d657267
+
+
+class MergePartnerJob(orm.Model):
+    """
+    Persistent merge of the groups found by the merge wizard. The status of
+    every group is saved and committed at each checkpoint, so an
+    interrupted job is resumed by the cron where it stopped.
+    """
+    _name = 'base.partner.merge.job'
+    _description = 'Contact Merge Job'
+    _order = 'id desc'
+
+    def _get_speed(self, cr, uid, ids, field_name, arg, context=None):
+        result = {}
+        for job in self.browse(cr, uid, ids, context=context):
+            processed = (job.merged_count + job.skipped_count +
+                         job.failed_count)
+            result[job.id] = (processed / job.run_time
+                              if job.run_time else 0.0)
+        return result
+
+    _columns = {
+        'name': fields.char('Name', required=True),
+        'state': fields.selection([('pending', 'Pending'),
+                                   ('running', 'Running'),
+                                   ('done', 'Done'),
+                                   ('cancel', 'Cancelled')],
+                                  'State', readonly=True, required=True),
+        'query': fields.text('Candidate query', readonly=True),
+        'group_ids': fields.one2many('base.partner.merge.job.group',
+                                     'job_id', 'Groups', readonly=True),
+        'stage_ids': fields.one2many('base.partner.merge.job.stage',
+                                     'job_id', 'Statistics', readonly=True),
+        'group_count': fields.integer('Groups', readonly=True),
+        'merged_count': fields.integer('Merged', readonly=True),
+        'skipped_count': fields.integer('Skipped', readonly=True),
+        'failed_count': fields.integer('Failed', readonly=True),
+        'lock_timeout': fields.integer(
+            'Lock timeout (ms)',
+            help="See the option of the same name of the merge wizard"),
+        'run_time': fields.float('Run time (seconds)', readonly=True),
+        'speed': fields.function(_get_speed, type='float',
+                                 string='Groups per second'),
+        'date_start': fields.datetime('Started on', readonly=True),
+        'date_checkpoint': fields.datetime('Last checkpoint',
+                                           readonly=True),
+    }
+
+    _defaults = {
+        'name': lambda *a: 'Merge of %s' % time.strftime('%Y-%m-%d %H:%M'),
+        'state': 'pending',
+        'group_count': 0,
+        'merged_count': 0,
+        'skipped_count': 0,
+        'failed_count': 0,
+        'run_time': 0.0,
+    }
+
+    def create_from_wizard(self, cr, uid, wizard_id, query, context=None):
+        """Create a job with the lines of the merge wizard, which are
+        removed from the wizard"""
+        wizard = self.pool['base.partner.merge.automatic.wizard'].browse(
+            cr, uid, wizard_id, context=context)
+        job_id = self.create(cr, uid, {
+            'query': query,
+            'lock_timeout': wizard.lock_timeout,
+        }, context=context)
+        cr.execute("""
+            INSERT INTO base_partner_merge_job_group
+                (job_id, min_id, aggr_ids, state)
+            SELECT %s, min_id, aggr_ids, 'pending'
+            FROM base_partner_merge_line
+            WHERE wizard_id = %s""", (job_id, wizard_id))
+        self.write(cr, uid, [job_id], {'group_count': cr.rowcount},
+                   context=context)
+        cr.execute("DELETE FROM base_partner_merge_line WHERE wizard_id = %s",
+                   (wizard_id,))
+        return job_id
+
+    def cancel_cb(self, cr, uid, ids, context=None):
+        return self.write(cr, uid, ids, {'state': 'cancel'}, context=context)
+
+    def resume_cb(self, cr, uid, ids, context=None):
+        return self.write(cr, uid, ids, {'state': 'pending'}, context=context)
+
+    def retry_failed_cb(self, cr, uid, ids, context=None):
+        for job in self.browse(cr, uid, ids, context=context):
+            cr.execute("""UPDATE base_partner_merge_job_group
+                             SET state = 'pending', reason = NULL
+                           WHERE job_id = %s AND state = 'failed'""",
+                       (job.id,))
+            job.write({'state': 'pending',
+                       'failed_count': job.failed_count - cr.rowcount})
+        return True
+
+    def _get_merge_group(self, cr, uid, partner_ids, context=None):
+        """Return the (dst_id, src_ids) merge of the existing partner_ids,
+        or None if less than two of them are left"""
+        existing_ids = self.pool['res.partner'].exists(
+            cr, uid, partner_ids, context=context)
+        if len(existing_ids) < 2:
+            return None
+        ordered_partners = self.pool[
+            'base.partner.merge.automatic.wizard']._get_ordered_partner(
+                cr, uid, existing_ids, context=context)
+        return (ordered_partners[-1].id,
+                [partner.id for partner in ordered_partners[:-1]])
+
+    def _merge_group(self, cr, uid, partner_ids, stats=None, context=None):
+        """Merge partner_ids in a savepoint
+
+        :param stats: MergeStats the measures of the merge are added to
+        :return: the (state, reason) of the group
+        """
+        wizard_obj = self.pool['base.partner.merge.automatic.wizard']
+        cr.execute("SAVEPOINT merge_job_group")
+        try:
+            group = self._get_merge_group(cr, uid, partner_ids,
+                                          context=context)
+            if group is None:
+                result = ('skipped', _('Less than two contacts left'))
+            else:
+                wizard_obj.merge_groups(cr, uid, [group], commit=False,
+                                        stats=stats, context=context)
+                result = ('merged', None)
+            cr.execute("RELEASE SAVEPOINT merge_job_group")
+        except Exception as e:
+            cr.execute("ROLLBACK TO SAVEPOINT merge_job_group")
+            self.invalidate_cache(cr, uid, context=context)
+            reason = e.value if isinstance(e, orm.except_orm) else e
+            result = ('failed', tools.ustr(reason))
+        return result
+
+    def _merge_chunk(self, cr, uid, groups, stats=None, context=None):
+        """Merge the (group id, partner ids) groups with one call of
+        merge_groups, or group by group if the chunk fails, so that only
+        the failing groups are reported
+
+        :return: {group id: (state, reason)}
+        """
+        wizard_obj = self.pool['base.partner.merge.automatic.wizard']
+        results, merges = {}, []
+        cr.execute("SAVEPOINT merge_job_chunk")
+        try:
+            for group_id, partner_ids in groups:
+                group = self._get_merge_group(cr, uid, partner_ids,
+                                              context=context)
+                if group is None:
+                    results[group_id] = ('skipped',
+                                         _('Less than two contacts left'))
+                else:
+                    merges.append((group_id, group))
+            chunk_stats = MergeStats(
+                count_rows=stats is not None and stats.count_rows)
+            wizard_obj.merge_groups(
+                cr, uid, [group for dummy, group in merges], commit=False,
+                stats=chunk_stats, context=context)
+            cr.execute("RELEASE SAVEPOINT merge_job_chunk")
+        except Exception:
+            cr.execute("ROLLBACK TO SAVEPOINT merge_job_chunk")
+            self.invalidate_cache(cr, uid, context=context)
+            _logger.info('merge job chunk failed, merging its groups one '
+                         'by one', exc_info=True)
+            return dict(
+                (group_id, self._merge_group(cr, uid, partner_ids,
+                                             stats=stats, context=context))
+                for group_id, partner_ids in groups)
+        if stats is not None:
+            stats.update(chunk_stats)
+        results.update((group_id, ('merged', None))
+                       for group_id, dummy in merges)
+        return results
+
+    def _run(self, cr, uid, job_id, context=None):
+        """Merge the pending groups of the job, committing the status of
+        the groups after every chunk. Does nothing if the job is already
+        running in another transaction."""
+        cr.execute("SELECT pg_try_advisory_lock(%s, %s)",
+                   (JOB_LOCK_KEY, job_id))
+        if not cr.fetchone()[0]:
+            return False
+        wizard_obj = self.pool['base.partner.merge.automatic.wizard']
+        try:
+            job = self.browse(cr, uid, job_id, context=context)
+            lock_timeout = job.lock_timeout
+            if lock_timeout:
+                context = dict(context or {},
+                               merge_lock_timeout=lock_timeout)
+            values = {'state': 'running'}
+            if not job.date_start:
+                values['date_start'] = fields.datetime.now()
+            job.write(values)
+            cr.commit()
+
+            while True:
+                cr.execute("SELECT state FROM base_partner_merge_job "
+                           "WHERE id = %s", (job_id,))
+                if cr.fetchone()[0] != 'running':
+                    return False
+                cr.execute("""SELECT id, aggr_ids
+                                FROM base_partner_merge_job_group
+                               WHERE job_id = %s AND state = 'pending'
+                            ORDER BY min_id
+                               LIMIT %s""", (job_id, JOB_CHUNK_SIZE))
+                groups = cr.fetchall()
+                if not groups:
+                    break
+
+                start = time.time()
+                counters = dict.fromkeys(('merged', 'skipped', 'failed'), 0)
+                stats = MergeStats()
+                if lock_timeout:
+                    # the references are moved before the transaction of
+                    # the chunk starts
+                    cr.commit()
+                    wizard_obj._move_references(
+                        cr, uid, [(None, partner_ids)
+                                  for dummy, partner_ids in groups],
+                        lock_timeout, context=context)
+                results = self._merge_chunk(cr, uid, groups, stats=stats,
+                                            context=context)
+                for group_id, (state, reason) in results.iteritems():
+                    cr.execute("""UPDATE base_partner_merge_job_group
+                                     SET state = %s, reason = %s
+                                   WHERE id = %s""",
+                               (state, reason, group_id))
+                    counters[state] += 1
+
+                cr.execute("""
+                    UPDATE base_partner_merge_job
+                       SET merged_count = merged_count + %s,
+                           skipped_count = skipped_count + %s,
+                           failed_count = failed_count + %s,
+                           run_time = run_time + %s,
+                           date_checkpoint = now() at time zone 'UTC'
+                     WHERE id = %s""", (counters['merged'],
+                                        counters['skipped'],
+                                        counters['failed'],
+                                        time.time() - start, job_id))
+                self.pool['base.partner.merge.job.stage'].add_stats(
+                    cr, job_id, stats)
+                cr.commit()
+                _logger.info('merge job %s: %s merged, %s skipped, '
+                             '%s failed', job_id, counters['merged'],
+                             counters['skipped'], counters['failed'])
+                _logger.info('merge_stats %s', stats.format(job_id=job_id))
+
+            self.write(cr, uid, [job_id], {'state': 'done'}, context=context)
+            cr.commit()
+            return True
+        finally:
+            # an error leaves the transaction aborted, which would hide it
+            # and keep the session lock
+            cr.rollback()
+            cr.execute("SELECT pg_advisory_unlock(%s, %s)",
+                       (JOB_LOCK_KEY, job_id))
+
+    def _cron_run_jobs(self, cr, uid, context=None):
+        """Run the pending jobs and resume the interrupted ones"""
+        job_ids = self.search(cr, uid,
+                              [('state', 'in', ('pending', 'running'))],
+                              order='id', context=context)
+        for job_id in job_ids:
+            self._run(cr, uid, job_id, context=context)
+        return True
+
+
+class MergePartnerJobGroup(orm.Model):
+    """A group of partners of a merge job. As for base.partner.merge.line,
+    the partner ids are stored in the integer[] column aggr_ids."""
+    _name = 'base.partner.merge.job.group'
+    _description = 'Contact Merge Job Group'
+    _log_access = False
+    _order = 'min_id'
+
+    def _get_partner_ids_display(self, cr, uid, ids, field_name, arg,
+                                 context=None):
+        cr.execute("SELECT id, array_to_string(aggr_ids, ', ') "
+                   "FROM base_partner_merge_job_group WHERE id IN %s",
+                   (tuple(ids),))
+        return dict(cr.fetchall())
+
+    _columns = {
+        'job_id': fields.many2one('base.partner.merge.job', 'Job',
+                                  required=True, select=True,
+                                  ondelete='cascade'),
+        'min_id': fields.integer('MinID'),
+        'partner_ids_display': fields.function(_get_partner_ids_display,
+                                               type='char',
+                                               string='Contact IDs'),
+        'state': fields.selection([('pending', 'Pending'),
+                                   ('merged', 'Merged'),
+                                   ('skipped', 'Skipped'),
+                                   ('failed', 'Failed')],
+                                  'State', required=True, select=True),
+        'reason': fields.text('Reason'),
+    }
+
+    def _auto_init(self, cr, context=None):
+        res = super(MergePartnerJobGroup, self)._auto_init(cr,
+                                                           context=context)
+        add_aggr_ids_column(cr, self._table)
+        return res
+
+
+class MergePartnerJobStage(orm.Model):
+    """Time spent, queries run and rows written by a stage of the merges of
+    a job"""
+    _name = 'base.partner.merge.job.stage'
+    _description = 'Contact Merge Job Statistics'
+    _log_access = False
+    _order = 'job_id, sequence'
+
+    _columns = {
+        'job_id': fields.many2one('base.partner.merge.job', 'Job',
+                                  required=True, select=True,
+                                  ondelete='cascade'),
+        'sequence': fields.integer('Sequence'),
+        'stage': fields.selection(MERGE_STAGES, 'Stage', required=True),
+        'seconds': fields.float('Time (seconds)'),
+        'query_count': fields.integer('Queries'),
+        'row_count': fields.integer('Written rows'),
+    }
+
+    def add_stats(self, cr, job_id, stats):
+        """Add the measures of the MergeStats stats to the job"""
+        for sequence, (stage, seconds, queries, rows) in enumerate(
+                stats.items()):
+            cr.execute("""UPDATE base_partner_merge_job_stage
+                             SET seconds = seconds + %s,
+                                 query_count = query_count + %s,
+                                 row_count = row_count + %s
+                           WHERE job_id = %s AND stage = %s""",
+                       (seconds, queries, rows, job_id, stage))
+            if not cr.rowcount:
+                cr.execute("""INSERT INTO base_partner_merge_job_stage
+                                  (job_id, sequence, stage, seconds,
+                                   query_count, row_count)
+                              VALUES (%s, %s, %s, %s, %s, %s)""",
+                           (job_id, sequence, stage, seconds, queries, rows))
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""Split groups of partners to merge in partitions which can be merged
+concurrently.
+
+Merging a group rewrites the rows pointing to its partners, including the
+parent_id of their children, so two groups can only be merged at the same
+time if they share neither a partner nor a parent chain.
+"""
+
+import heapq
+
+from .duplicate_detection import UnionFind
+
+
+def partition_groups(groups, ancestors, partitions):
+    """Split groups in independent partitions of balanced sizes
+
+    :param groups: list of (key, partner_ids) tuples
+    :param ancestors: dictionary {partner id: ids of all its ancestors}
+    :param partitions: maximal number of partitions
+    :return: list of lists of groups, keeping the order of groups in each
+             partition
+    """
+    union_find = UnionFind()
+    for dummy, partner_ids in groups:
+        first = partner_ids[0]
+        for partner_id in partner_ids:
+            union_find.union(first, partner_id)
+            for ancestor_id in ancestors.get(partner_id, ()):
+                union_find.union(first, ancestor_id)
+
+    components = {}
+    for index, group in enumerate(groups):
+        components.setdefault(union_find.find(group[1][0]), []).append(
+            (index, group))
+
+    # the largest components first, each one in the smallest partition
+    heap = [(0, index, []) for index in xrange(partitions)]
+    for component in sorted(components.itervalues(), key=len, reverse=True):
+        size, index, partition = heapq.heappop(heap)
+        partition.extend(component)
+        heapq.heappush(heap, (size + len(component), index, partition))
+
+    return [[group for dummy, group in sorted(partition)]
+            for dummy, dummy, partition in sorted(heap, key=lambda x: x[1])
+            if partition]
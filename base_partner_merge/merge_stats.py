@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""Instrumentation of the merges.
+
+Each stage of a merge is measured with its duration, the number of SQL
+queries it ran (counted by the OpenERP cursor) and optionally the number
+of rows it inserted, updated or deleted (counted by PostgreSQL in
+pg_stat_xact_user_tables for the current transaction).
+"""
+
+import logging
+import time
+from contextlib import contextmanager
+
+_logger = logging.getLogger('base.partner.merge')
+
+MERGE_STAGES = [
+    ('foreign_keys', 'Foreign keys'),
+    ('reference_fields', 'Reference fields'),
+    ('values', 'Values'),
+    ('message', 'Message'),
+    ('unlink', 'Unlink'),
+]
+
+
+def written_rows(cr):
+    """Number of rows written by the current transaction"""
+    cr.execute("SELECT coalesce(sum(n_tup_ins + n_tup_upd + n_tup_del), 0) "
+               "FROM pg_stat_xact_user_tables")
+    return int(cr.fetchone()[0])
+
+
+class MergeStats(object):
+    """Duration, queries and written rows of the stages of one or several
+    merges"""
+
+    def __init__(self, count_rows=None):
+        """:param count_rows: count the written rows, which costs two
+                              catalog queries per stage. By default, only
+                              when the debug logs of the merges are
+                              enabled."""
+        if count_rows is None:
+            count_rows = _logger.isEnabledFor(logging.DEBUG)
+        self.count_rows = count_rows
+        self.merges = 0
+        # {stage: [seconds, queries, rows]}
+        self.stages = dict((stage, [0.0, 0, 0])
+                           for stage, dummy in MERGE_STAGES)
+
+    @contextmanager
+    def stage(self, cr, name):
+        start = time.time()
+        queries = cr.sql_log_count
+        rows = written_rows(cr) if self.count_rows else 0
+        yield
+        queries = cr.sql_log_count - queries
+        if self.count_rows:
+            # the first query of written_rows is counted
+            queries -= 1
+            rows = written_rows(cr) - rows
+        self.add_stage(name, time.time() - start, queries, rows)
+
+    def add_stage(self, name, seconds, queries, rows):
+        totals = self.stages[name]
+        totals[0] += seconds
+        totals[1] += queries
+        totals[2] += rows
+
+    def update(self, other):
+        """Add the measures of the MergeStats other"""
+        self.count_rows = self.count_rows or other.count_rows
+        self.merges += other.merges
+        for name, (seconds, queries, rows) in other.stages.iteritems():
+            self.add_stage(name, seconds, queries, rows)
+
+    def items(self):
+        """Return the (stage, seconds, queries, rows) by stage order"""
+        return [(stage,) + tuple(self.stages[stage])
+                for stage, dummy in MERGE_STAGES]
+
+    def format(self, **fields):
+        """Format the measures as key=value pairs, preceded by fields"""
+        pairs = ['%s=%s' % item for item in sorted(fields.iteritems())]
+        pairs.append('merges=%s' % self.merges)
+        for stage, seconds, queries, rows in self.items():
+            pairs.extend(['%s_seconds=%.3f' % (stage, seconds),
+                          '%s_queries=%s' % (stage, queries)])
+            if self.count_rows:
+                pairs.append('%s_rows=%s' % (stage, rows))
+        return ' '.join(pairs)
+
+    def report(self):
+        """Human readable summary, one line per stage"""
+        lines = []
+        for (stage, label), (dummy, seconds, queries, rows) in zip(
+                MERGE_STAGES, self.items()):
+            line = '%s: %.3f s, %s queries' % (label, seconds, queries)
+            if self.count_rows:
+                line += ', %s rows' % rows
+            lines.append(line)
+        return '\n'.join(lines)
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""Batch check of the mail exchangers of email addresses.
+
+validate_email(check_mx=True) resolves and connects to the mail exchangers
+of every address, one after the other. MXValidator checks each domain only
+once, caches the result for some time and checks the domains in a pool of
+threads. The resolver is pluggable, so any DNS library (or a stub in the
+tests) can be used.
+"""
+
+import logging
+import smtplib
+import socket
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from .validate_email import DNS, VALID_ADDRESS_RE
+
+_logger = logging.getLogger(__name__)
+
+
+class PyDNSResolver(object):
+    """Resolve the mail exchangers with pyDNS"""
+
+    def __init__(self, timeout=5):
+        if not DNS:
+            raise Exception('For check the mx records you must have '
+                            'installed pyDNS python package')
+        self.timeout = timeout
+        DNS.DiscoverNameServers()
+
+    def mx_hosts(self, domain):
+        """Return the mail exchangers of domain, by priority"""
+        return [host for priority, host
+                in sorted(DNS.mxlookup(domain, timeout=self.timeout))]
+
+
+class MXValidator(object):
+    """Check that the domains of email addresses have a mail exchanger,
+    optionally accepting SMTP connections
+
+    :param resolver: object with a mx_hosts(domain) method returning the
+                     host names of the mail exchangers of domain
+    :param ttl: seconds during which the result of a domain is cached
+    :param workers: number of domains checked in parallel
+    :param smtp_check: also check that a mail exchanger accepts connections
+    :param smtp_port: port of the SMTP connections
+    :param timeout: timeout of the SMTP connections, in seconds
+    """
+
+    def __init__(self, resolver=None, ttl=3600, workers=10,
+                 smtp_check=False, smtp_port=25, timeout=10):
+        self.resolver = resolver or PyDNSResolver()
+        self.ttl = ttl
+        self.workers = workers
+        self.smtp_check = smtp_check
+        self.smtp_port = smtp_port
+        self.timeout = timeout
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def _check_smtp(self, host):
+        smtp = smtplib.SMTP(timeout=self.timeout)
+        try:
+            smtp.connect(host, self.smtp_port)
+            smtp.quit()
+        except (smtplib.SMTPException, socket.error):
+            return False
+        return True
+
+    def check_domain(self, domain):
+        """Return whether domain has a valid mail exchanger, uncached"""
+        try:
+            hosts = self.resolver.mx_hosts(domain)
+        except Exception:
+            _logger.debug('MX lookup of %s failed', domain, exc_info=True)
+            return False
+        if not self.smtp_check:
+            return bool(hosts)
+        return any(self._check_smtp(host) for host in hosts)
+
+    def _get_cached(self, domain, now):
+        with self._lock:
+            result, expiry = self._cache.get(domain, (None, 0))
+        return result if expiry > now else None
+
+    def _set_cached(self, results, now):
+        with self._lock:
+            for domain, result in results:
+                self._cache[domain] = (result, now + self.ttl)
+
+    def validate(self, emails):
+        """Return a dictionary {email: whether email is valid}"""
+        now = time.time()
+        domains = {}
+        result = {}
+        for email in emails:
+            if not email or VALID_ADDRESS_RE.match(email) is None:
+                result[email] = False
+                continue
+            domain = email.rsplit('@', 1)[1].lower()
+            domains.setdefault(domain, []).append(email)
+
+        valid_domains = {}
+        to_check = []
+        for domain in domains:
+            cached = self._get_cached(domain, now)
+            if cached is None:
+                to_check.append(domain)
+            else:
+                valid_domains[domain] = cached
+
+        if to_check:
+            pool = ThreadPool(min(self.workers, len(to_check)))
+            try:
+                checked = zip(to_check, pool.map(self.check_domain, to_check))
+            finally:
+                pool.close()
+                pool.join()
+            self._set_cached(checked, now)
+            valid_domains.update(checked)
+
+        for domain, domain_emails in domains.iteritems():
+            for email in domain_emails:
+                result[email] = valid_domains[domain]
+        return result
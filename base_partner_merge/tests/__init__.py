@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from . import test_duplicate_detection
+from . import test_sanitize_email
+from . import test_mx_validation
+from . import test_merge_scheduler
+from . import test_merge_job
+from . import test_merge_plan
+from . import test_email_columns
+from . import test_merge_impact
+from . import test_lock_aware_merge
+from . import test_merge_stats
+from . import test_merge_groups
+from . import test_merge_keys
+from . import test_reference_fields
+from . import test_aggr_ids_column
+from . import test_clean_emails
+from . import test_auto_set_parent
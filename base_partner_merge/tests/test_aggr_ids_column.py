@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+from ..base_partner_merge import add_aggr_ids_column
+
+
+class TestAggrIdsColumn(common.TransactionCase):
+
+    def _is_nullable(self, table):
+        self.cr.execute("SELECT is_nullable FROM information_schema.columns "
+                        "WHERE table_name = %s AND column_name = 'aggr_ids'",
+                        (table,))
+        return self.cr.fetchone()[0] == 'YES'
+
+    def test_not_null(self):
+        for table in ('base_partner_merge_line',
+                      'base_partner_merge_job_group'):
+            # as done by _auto_init for the columns unknown to the ORM
+            self.cr.execute('ALTER TABLE "%s" ALTER COLUMN aggr_ids '
+                            'DROP NOT NULL' % table)
+            add_aggr_ids_column(self.cr, table)
+            self.assertFalse(self._is_nullable(table))
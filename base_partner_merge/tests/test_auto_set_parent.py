@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+
+class TestAutoSetParent(common.TransactionCase):
+    """The grades and the invoices come from crm_partner_assignment and
+    account, which are not dependencies of the module"""
+
+    def setUp(self):
+        super(TestAutoSetParent, self).setUp()
+        self.partner_model = self.env['res.partner']
+        if ('grade_id' not in self.partner_model._fields or
+                'account.invoice' not in self.env.registry):
+            self.skipTest('crm_partner_assignment and account are needed')
+        grade = self.env['res.partner.grade'].create(
+            {'name': 'Auto Set Parent Grade'})
+        self.company = self._partner('info@parent-test.example', grade)
+        self.reseller = self._partner('sales@parent-test.example', grade)
+        self.children = (self._partner('a@parent-test.example') |
+                         self._partner('b@parent-test.example'))
+        # the graded partner with the most invoices is the parent
+        self._invoice(self.company)
+        self._invoice(self.company)
+        self._invoice(self.reseller)
+        self.wizard = self.env['base.partner.merge.automatic.wizard'].create(
+            {})
+
+    def _partner(self, email, grade=None):
+        return self.partner_model.create({
+            'name': email, 'email': email, 'is_company': bool(grade),
+            'grade_id': grade and grade.id})
+
+    def _invoice(self, partner):
+        invoice = self.env['account.invoice'].create({
+            'partner_id': partner.id,
+            'account_id': partner.property_account_receivable.id})
+        self.cr.execute("UPDATE account_invoice SET state = 'open' "
+                        "WHERE id = %s", (invoice.id,))
+
+    def test_auto_set_parent_id(self):
+        self.wizard.auto_set_parent_id()
+        self.env.invalidate_all()
+        for partner in self.children | self.reseller:
+            self.assertEqual(partner.parent_id, self.company)
+        self.assertFalse(self.company.parent_id)
+
+    def test_dry_run(self):
+        report = self.wizard.with_context(dry_run=True).auto_set_parent_id()
+        self.assertIn(
+            ('parent-test.example', self.company.id,
+             sorted((self.children | self.reseller).ids)),
+            [(domain, parent_id, sorted(child_ids))
+             for domain, parent_id, child_ids in report])
+        self.env.invalidate_all()
+        for partner in self.children | self.reseller:
+            self.assertFalse(partner.parent_id)
+
+    def test_several_invoiced(self):
+        # the domains where more than one other partner has invoices are
+        # skipped
+        self._invoice(self.children[0])
+        self.wizard.auto_set_parent_id()
+        self.env.invalidate_all()
+        for partner in self.children | self.reseller:
+            self.assertFalse(partner.parent_id)
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+from ..base_partner_merge import normalize_name
+
+
+class TestCleanEmails(common.TransactionCase):
+
+    def setUp(self):
+        super(TestCleanEmails, self).setUp()
+        self.partner_model = self.env['res.partner']
+        self.upper = self.partner_model.create({
+            'name': 'Clean Emails Upper', 'email': 'Clean.Upper@Example.COM'})
+        self.several = self.partner_model.create({
+            'name': 'Clean Emails Several',
+            'email': 'clean.a@example.com;clean.b@example.org'})
+        self.env['base.partner.merge.automatic.wizard'].clean_emails()
+        self.env.invalidate_all()
+
+    def test_lowercase(self):
+        self.assertEqual(self.upper.email, 'clean.upper@example.com')
+        self.assertEqual(self.upper.email_normalized,
+                         'clean.upper@example.com')
+
+    def test_split(self):
+        self.assertEqual(self.several.email, 'clean.a@example.com')
+        self.assertEqual(self.several.email_normalized,
+                         'clean.a@example.com')
+        self.assertEqual(self.several.email_domain, 'example.com')
+        copies = self.partner_model.search(
+            [('email', '=', 'clean.b@example.org')])
+        self.assertEqual(len(copies), 1)
+        self.assertTrue(copies.name.startswith('Clean Emails Several'))
+        self.assertEqual(copies.email_domain, 'example.org')
+        # the merge keys of the copy are indexed
+        self.cr.execute("SELECT name FROM base_partner_merge_key "
+                        "WHERE partner_id = %s", (copies.id,))
+        self.assertEqual(self.cr.fetchone()[0], normalize_name(copies.name))
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+from ..duplicate_detection import find_duplicate_groups, name_key, soundex
+
+
+class TestDuplicateDetection(common.TransactionCase):
+
+    def test_name_key(self):
+        self.assertEqual(name_key('ACME S.A.'), name_key(u'Acm\xe9  SA'))
+        self.assertEqual(name_key('John Smith'), name_key('Smith, John'))
+        self.assertEqual(soundex('robert'), soundex('rupert'))
+
+    def test_find_duplicate_groups(self):
+        groups = find_duplicate_groups([
+            (1, 'ACME S.A.', 'info@acme.com', '1000'),
+            (2, 'Acme SA', False, False),
+            (3, 'John Smith', False, '2000'),
+            (4, 'Smith John', False, False),
+            (5, 'Someone Else', 'info@acme.com', False),
+            (6, 'Nobody', False, '2000'),
+        ])
+        self.assertEqual(groups, [[1, 2, 5], [3, 4]])
+
+    def test_wizard_fuzzy_match(self):
+        partner_model = self.env['res.partner']
+        partner1 = partner_model.create({'name': 'Fuzzy Test Company S.A.'})
+        partner2 = partner_model.create({'name': 'fuzzy test company SA'})
+        wizard = self.env['base.partner.merge.automatic.wizard'].create({
+            'fuzzy_match': True,
+            'maximum_group': 0,
+        })
+        wizard.start_process_cb()
+        self.assertIn(
+            sorted([partner1.id, partner2.id]),
+            [sorted(aggr_ids)
+             for aggr_ids in wizard.line_ids.get_aggr_ids().values()])
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+
+class TestEmailColumns(common.TransactionCase):
+
+    def setUp(self):
+        super(TestEmailColumns, self).setUp()
+        self.partner = self.env['res.partner'].create({
+            'name': 'Email Columns Test',
+            'email': ' John.Doe@Example.COM '})
+
+    def test_create(self):
+        self.assertEqual(self.partner.email_normalized,
+                         'john.doe@example.com')
+        self.assertEqual(self.partner.email_domain, 'example.com')
+
+    def test_write(self):
+        self.partner.write({'email': 'jane@Example.org'})
+        self.assertEqual(self.partner.email_normalized, 'jane@example.org')
+        self.assertEqual(self.partner.email_domain, 'example.org')
+        self.partner.write({'email': False})
+        self.assertFalse(self.partner.email_domain)
+
+    def test_search_domain(self):
+        partners = self.env['res.partner'].search(
+            [('email_domain', '=', 'example.com')])
+        self.assertIn(self.partner, partners)
+
+    def test_default_email(self):
+        partner = self.env['res.partner'].with_context(
+            default_email='Default@Example.net').create(
+            {'name': 'Email Columns Default'})
+        self.assertEqual(partner.email_normalized, 'default@example.net')
+        self.assertEqual(partner.email_domain, 'example.net')
+
+    def test_copy(self):
+        partner = self.partner.copy()
+        self.assertEqual(partner.email_normalized, 'john.doe@example.com')
+        self.assertEqual(partner.email_domain, 'example.com')
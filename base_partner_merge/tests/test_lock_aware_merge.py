@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+from contextlib import closing
+from mock import patch
+from openerp import api
+import openerp.tests.common as common
+from .. import base_partner_merge
+
+
+class TestLockAwareMerge(common.TransactionCase):
+
+    def test_merge_lock_timeout(self):
+        partner_model = self.env['res.partner']
+        src = partner_model.create({'name': 'Lock Aware Merge Test',
+                                    'is_company': True})
+        dst = partner_model.create({'name': 'Lock Aware Merge Test',
+                                    'is_company': True})
+        child = partner_model.create({'name': 'Lock Aware Merge Child',
+                                      'parent_id': src.id})
+        self.assertEqual(child.commercial_partner_id, src)
+
+        wizard_model = self.env['base.partner.merge.automatic.wizard']
+        wizard_model.with_context(merge_lock_timeout=500)._merge(
+            [src.id, dst.id], dst_partner=dst)
+        child.invalidate_cache()
+        self.assertFalse(src.exists())
+        self.assertEqual(child.parent_id, dst)
+        self.assertEqual(child.commercial_partner_id, dst)
+
+    def test_merge_groups_lock_timeout(self):
+        partner_model = self.env['res.partner']
+        partners = [partner_model.create({'name': 'Lock Aware Group Test'})
+                    for dummy in range(4)]
+        child = partner_model.create({'name': 'Lock Aware Group Child',
+                                      'parent_id': partners[1].id})
+        wizard_model = self.env['base.partner.merge.automatic.wizard']
+        wizard_model.with_context(merge_lock_timeout=500).merge_groups(
+            [(partners[0].id, [p.id for p in partners[1:]])], commit=False)
+        child.invalidate_cache()
+        self.assertEqual(child.parent_id, partners[0])
+
+    def test_move_references_in_transaction(self):
+        # the transaction of the test is open, its snapshot would conflict
+        # with the rows moved by a separate cursor
+        partner_model = self.env['res.partner']
+        src = partner_model.create({'name': 'Lock Aware Move Test'})
+        dst = partner_model.create({'name': 'Lock Aware Move Test'})
+        attachment = self.env['ir.attachment'].create({
+            'name': 'Lock Aware Move Attachment',
+            'res_model': 'res.partner',
+            'res_id': src.id})
+        self.env['base.partner.merge.automatic.wizard']._move_references(
+            [(dst.id, [src.id, dst.id])], 500)
+        attachment.invalidate_cache()
+        self.assertEqual(attachment.res_id, src.id)
+
+    def test_move_rows_locked(self):
+        # the rows are moved by batches committed on their own, so the
+        # partners are committed on a cursor of their own and removed after
+        uid = self.uid
+        with closing(self.registry.cursor()) as cr:
+            partner_model = api.Environment(cr, uid, {})['res.partner']
+            src = partner_model.create({'name': 'Lock Aware Rows Test'})
+            dst = partner_model.create({'name': 'Lock Aware Rows Test'})
+            children = [
+                partner_model.create({'name': 'Lock Aware Rows Child',
+                                      'parent_id': src.id})
+                for dummy in range(3)]
+            partner_ids = [src.id, dst.id] + [c.id for c in children]
+            child_ids = [c.id for c in children]
+            cr.commit()
+        try:
+            with closing(self.registry.cursor()) as lock_cr, \
+                    closing(self.registry.cursor()) as cr:
+                lock_cr.execute("SELECT id FROM res_partner WHERE id = %s "
+                                "FOR UPDATE", (child_ids[0],))
+                wizard_model = self.registry(
+                    'base.partner.merge.automatic.wizard')
+                with patch.object(base_partner_merge, 'LOCK_BATCH_SIZE', 1), \
+                        patch.object(base_partner_merge.time, 'sleep',
+                                     side_effect=lambda s: lock_cr.rollback()
+                                     ) as sleep:
+                    moved = wizard_model._move_rows(
+                        cr, 'res_partner', 'parent_id', 'TRUE', [src.id],
+                        [dst.id], 500)
+                self.assertEqual(moved, 3)
+                self.assertEqual(sleep.call_count, 1)
+                cr.execute("SELECT parent_id FROM res_partner "
+                           "WHERE id IN %s", (tuple(child_ids),))
+                self.assertEqual(cr.fetchall(), [(dst.id,)] * 3)
+        finally:
+            with closing(self.registry.cursor()) as cr:
+                partner_model = api.Environment(cr, uid, {})['res.partner']
+                partner_model.browse(partner_ids).unlink()
+                cr.commit()
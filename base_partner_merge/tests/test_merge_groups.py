@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+
+class TestMergeGroups(common.TransactionCase):
+
+    def setUp(self):
+        super(TestMergeGroups, self).setUp()
+        self.wizard_model = self.env['base.partner.merge.automatic.wizard']
+        self.partner_model = self.env['res.partner']
+        self.category = self.env['res.partner.category'].create(
+            {'name': 'Merge Groups Test'})
+
+    def _create_group(self, name, size):
+        return [self.partner_model.create({
+            'name': name,
+            'category_id': [(6, 0, [self.category.id])],
+        }) for dummy in range(size)]
+
+    def _category_rows(self, partner):
+        self.cr.execute("SELECT count(*) "
+                        "FROM res_partner_res_partner_category_rel "
+                        "WHERE category_id = %s AND partner_id = %s",
+                        (self.category.id, partner.id))
+        return self.cr.fetchone()[0]
+
+    def test_merge_groups(self):
+        first = self._create_group('Merge Groups First', 5)
+        second = self._create_group('Merge Groups Second', 4)
+        merged = self.wizard_model.merge_groups(
+            [(first[0].id, [p.id for p in first[1:]]),
+             (second[0].id, [p.id for p in second[1:]])],
+            commit=False)
+        self.assertEqual(merged, 2)
+        src_ids = [p.id for p in first[1:] + second[1:]]
+        self.assertFalse(self.partner_model.browse(src_ids).exists())
+        # the m2m rows are deduplicated within each group
+        self.assertEqual(self._category_rows(first[0]), 1)
+        self.assertEqual(self._category_rows(second[0]), 1)
+
+    def test_merge_groups_parent_cycle(self):
+        group = self._create_group('Merge Groups Cycle', 4)
+        company = self.partner_model.create(
+            {'name': 'Merge Groups Company', 'is_company': True})
+        contact = self.partner_model.create(
+            {'name': 'Merge Groups Contact', 'parent_id': company.id})
+        self.wizard_model.merge_groups(
+            [(contact.id, [company.id]),
+             (group[0].id, [p.id for p in group[1:]])],
+            commit=False)
+        # the contact does not become its own parent
+        self.assertFalse(company.exists())
+        self.assertNotEqual(contact.parent_id, contact)
+        self.assertFalse(self.partner_model.browse(
+            [p.id for p in group[1:]]).exists())
+        self.assertEqual(self._category_rows(group[0]), 1)
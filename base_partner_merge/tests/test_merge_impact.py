@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+
+class TestMergeImpact(common.TransactionCase):
+
+    def setUp(self):
+        super(TestMergeImpact, self).setUp()
+        self.wizard_model = self.env['base.partner.merge.automatic.wizard']
+        partner_model = self.env['res.partner']
+        self.src = partner_model.create({'name': 'Merge Impact Test'})
+        self.dst = partner_model.create({'name': 'Merge Impact Test'})
+        self.child = partner_model.create({'name': 'Merge Impact Child',
+                                           'parent_id': self.src.id})
+
+    def test_merge_impact(self):
+        impact = self.wizard_model._get_merge_impact([self.src.id])
+        self.assertIn(('res_partner', 'parent_id', self.src.id, 1), impact)
+        self.assertFalse([row for row in impact if row[2] != self.src.id])
+        # nothing is changed
+        self.assertEqual(self.child.parent_id, self.src)
+
+    def test_dry_run_selection(self):
+        wizard = self.wizard_model.create({
+            'state': 'selection',
+            'partner_ids': [(6, 0, [self.src.id, self.dst.id])],
+            'dst_partner_id': self.dst.id,
+        })
+        wizard.dry_run_cb()
+        self.assertIn('res_partner.parent_id: 1 rows of 1 contacts',
+                      wizard.impact_report)
+        self.assertTrue(self.src.exists())
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+
+class TestMergeJob(common.TransactionCase):
+
+    def setUp(self):
+        super(TestMergeJob, self).setUp()
+        self.job_model = self.env['base.partner.merge.job']
+        partner_model = self.env['res.partner']
+        self.partner1 = partner_model.create({
+            'name': 'Merge Job Test', 'email': 'merge.job@example.com'})
+        self.partner2 = partner_model.create({
+            'name': 'Merge  job test', 'email': 'Merge.Job@example.com'})
+
+    def test_create_from_wizard(self):
+        wizard = self.env['base.partner.merge.automatic.wizard'].create({
+            'group_by_email': True,
+            'maximum_group': 0,
+        })
+        action = wizard.create_job_cb()
+        job = self.job_model.browse(action['res_id'])
+        self.assertEqual(job.state, 'pending')
+        self.assertTrue(job.query)
+        self.assertEqual(job.group_count, len(job.group_ids))
+        self.assertIn(
+            set([self.partner1.id, self.partner2.id]),
+            [set(int(i) for i in display.split(', '))
+             for display in job.group_ids.mapped('partner_ids_display')])
+        wizard.invalidate_cache()
+        self.assertFalse(wizard.line_ids)
+
+    def test_merge_group(self):
+        partner_ids = [self.partner1.id, self.partner2.id]
+        state, reason = self.job_model._merge_group(partner_ids)
+        self.assertEqual(state, 'merged')
+        self.assertEqual(len(self.env['res.partner'].browse(
+            partner_ids).exists()), 1)
+        state, reason = self.job_model._merge_group(partner_ids)
+        self.assertEqual(state, 'skipped')
+
+    def test_merge_chunk(self):
+        partner_model = self.env['res.partner']
+        large = [partner_model.create({'name': 'Merge Job Large'}).id
+                 for dummy in range(5)]
+        results = self.job_model._merge_chunk(
+            [(1, large), (2, [self.partner1.id, self.partner2.id])])
+        self.assertEqual(results, {1: ('merged', None), 2: ('merged', None)})
+        self.assertEqual(len(partner_model.browse(large).exists()), 1)
+
+    def test_merge_chunk_fallback(self):
+        partner3 = self.env['res.partner'].create({'name': 'Merge Job 3'})
+        # the second group shares a contact with the first one, so the
+        # chunk is merged group by group
+        results = self.job_model._merge_chunk(
+            [(1, [self.partner1.id, self.partner2.id]),
+             (2, [self.partner2.id, partner3.id])])
+        self.assertEqual(results[1], ('merged', None))
+        self.assertIn(results[2][0], ('merged', 'skipped'))
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+
+class TestMergeKeys(common.TransactionCase):
+
+    def setUp(self):
+        super(TestMergeKeys, self).setUp()
+        self.partner_model = self.env['res.partner']
+        self.partner = self.partner_model.create({
+            'name': 'Merge Keys Test', 'email': 'Keys@Example.com'})
+
+    def _get_key(self, column):
+        self.cr.execute("SELECT %s FROM base_partner_merge_key "
+                        "WHERE partner_id = %%s" % column,
+                        (self.partner.id,))
+        return self.cr.fetchone()[0]
+
+    def test_write(self):
+        self.partner.write({'name': 'Merge Keys Renamed'})
+        self.assertEqual(self._get_key('name'), 'merge keys renamed')
+
+    def test_stored_compute(self):
+        # a stored computed name is saved by _write, without name in the
+        # values passed to write
+        self.partner._write({'name': 'Merge Keys Computed'})
+        self.assertEqual(self._get_key('name'), 'merge keys computed')
+
+    def test_firstname(self):
+        if 'lastname' not in self.partner_model._fields:
+            self.skipTest('partner_firstname is not installed')
+        self.partner.write({'firstname': False,
+                            'lastname': 'Merge Keys Lastname'})
+        self.assertEqual(self.partner.name, 'Merge Keys Lastname')
+        self.assertEqual(self._get_key('name'), 'merge keys lastname')
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+
+class TestMergePlan(common.TransactionCase):
+
+    def setUp(self):
+        super(TestMergePlan, self).setUp()
+        self.wizard_model = self.env['base.partner.merge.automatic.wizard']
+        partner_model = self.env['res.partner']
+        self.src = partner_model.create({
+            'name': 'Merge Plan Test', 'email': 'plan@example.com',
+            'phone': '+41 21 619 10 10', 'city': 'Lausanne'})
+        self.dst = partner_model.create({
+            'name': 'Merge Plan Test', 'city': 'Geneva'})
+
+    def test_merge_plan(self):
+        plan = self.wizard_model._get_merge_plan([self.src.id], self.dst.id)
+        self.assertEqual(plan['email'], (self.src.id, 'plan@example.com'))
+        self.assertEqual(plan['phone'], (self.src.id, '+41 21 619 10 10'))
+        # the destination keeps its own values
+        self.assertNotIn('city', plan)
+        self.assertNotIn('name', plan)
+        # the preview does not change the partners
+        self.assertFalse(self.dst.email)
+
+    def test_update_values(self):
+        self.wizard_model._update_values(self.src, self.dst)
+        self.assertEqual(self.dst.email, 'plan@example.com')
+        self.assertEqual(self.dst.phone, '+41 21 619 10 10')
+        self.assertEqual(self.dst.city, 'Geneva')
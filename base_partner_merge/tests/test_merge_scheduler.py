@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+from ..merge_scheduler import partition_groups
+
+
+class TestMergeScheduler(common.TransactionCase):
+
+    def test_partition_groups(self):
+        groups = [
+            (1, [1, 2]),
+            (2, [3, 4]),
+            (3, [5, 6]),
+            (4, [2, 7]),
+            (5, [8, 9]),
+        ]
+        # 5 and 8 share the same parent company 10
+        ancestors = {5: [10], 8: [10, 11]}
+        partitions = partition_groups(groups, ancestors, 3)
+        self.assertEqual(len(partitions), 3)
+        keys = [[key for key, dummy in partition]
+                for partition in partitions]
+        self.assertIn([1, 4], keys)
+        self.assertIn([3, 5], keys)
+        self.assertIn([2], keys)
+
+    def test_partition_groups_single(self):
+        groups = [(1, [1, 2]), (2, [3, 4])]
+        self.assertEqual(partition_groups(groups, {}, 1), [groups])
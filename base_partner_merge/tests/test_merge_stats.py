@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+import openerp.tests.common as common
+
+from ..merge_stats import MergeStats
+
+
+class TestMergeStats(common.TransactionCase):
+
+    def test_stage(self):
+        stats = MergeStats(count_rows=True)
+        with stats.stage(self.cr, 'values'):
+            self.cr.execute("SELECT 1")
+            self.cr.execute("UPDATE res_partner SET active = active "
+                            "WHERE id = %s", (self.ref('base.main_partner'),))
+        seconds, queries, rows = stats.stages['values']
+        self.assertEqual(queries, 2)
+        self.assertEqual(rows, 1)
+        self.assertGreaterEqual(seconds, 0.0)
+
+    def test_stage_without_rows(self):
+        stats = MergeStats(count_rows=False)
+        with stats.stage(self.cr, 'values'):
+            self.cr.execute("SELECT 1")
+        seconds, queries, rows = stats.stages['values']
+        self.assertEqual(queries, 1)
+        self.assertEqual(rows, 0)
+        self.assertNotIn('rows', stats.format())
+        self.assertNotIn('rows', stats.report())
+
+    def test_update_format(self):
+        stats = MergeStats(count_rows=True)
+        other = MergeStats(count_rows=True)
+        other.merges = 2
+        other.add_stage('unlink', 0.5, 4, 3)
+        stats.update(other)
+        stats.update(other)
+        self.assertEqual(stats.merges, 4)
+        self.assertEqual(stats.stages['unlink'], [1.0, 8, 6])
+        line = stats.format(job_id=1)
+        self.assertTrue(line.startswith('job_id=1 merges=4 '))
+        self.assertIn('unlink_seconds=1.000 unlink_queries=8 '
+                      'unlink_rows=6', line)
+
+    def test_merge_stats(self):
+        partner_model = self.env['res.partner']
+        partner_ids = [
+            partner_model.create({'name': 'Merge Stats Test'}).id
+            for dummy in range(2)]
+        stats = self.env['base.partner.merge.automatic.wizard']._merge(
+            partner_ids, stats=MergeStats(count_rows=True))
+        self.assertEqual(stats.merges, 1)
+        self.assertGreater(stats.stages['foreign_keys'][1], 0)
+        self.assertGreater(stats.stages['unlink'][2], 0)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+import socket
+import threading
+
+import openerp.tests.common as common
+
+from ..mx_validation import MXValidator
+
+
+class StubResolver(object):
+
+    def __init__(self, mx_hosts):
+        self.mx_hosts_by_domain = mx_hosts
+        self.lookups = []
+
+    def mx_hosts(self, domain):
+        self.lookups.append(domain)
+        return self.mx_hosts_by_domain.get(domain, [])
+
+
+class StubSMTPServer(threading.Thread):
+    """Answer the greeting and the QUIT of one SMTP client at a time"""
+
+    def __init__(self):
+        super(StubSMTPServer, self).__init__()
+        self.daemon = True
+        self.socket = socket.socket()
+        self.socket.bind(('127.0.0.1', 0))
+        self.socket.listen(5)
+        self.port = self.socket.getsockname()[1]
+
+    def run(self):
+        while True:
+            try:
+                connection = self.socket.accept()[0]
+            except socket.error:
+                return
+            connection.sendall('220 stub ESMTP\r\n')
+            connection.recv(1024)
+            connection.sendall('221 bye\r\n')
+            connection.close()
+
+
+class TestMXValidation(common.TransactionCase):
+
+    def test_validate(self):
+        resolver = StubResolver({'example.com': ['mx.example.com']})
+        validator = MXValidator(resolver=resolver, workers=2)
+        emails = ['a@example.com', 'b@Example.com', 'c@nomx.com', 'invalid']
+        self.assertEqual(validator.validate(emails), {
+            'a@example.com': True,
+            'b@Example.com': True,
+            'c@nomx.com': False,
+            'invalid': False,
+        })
+        self.assertEqual(sorted(resolver.lookups),
+                         ['example.com', 'nomx.com'])
+        # the domains are cached
+        validator.validate(['d@example.com'])
+        self.assertEqual(len(resolver.lookups), 2)
+
+    def test_validate_smtp(self):
+        server = StubSMTPServer()
+        server.start()
+        # nothing listens on the port of the closed socket
+        closed = socket.socket()
+        closed.bind(('127.0.0.1', 0))
+        closed_port = closed.getsockname()[1]
+        closed.close()
+        resolver = StubResolver({'example.com': ['127.0.0.1']})
+        validator = MXValidator(resolver=resolver, smtp_check=True,
+                                smtp_port=server.port, timeout=5)
+        self.assertTrue(validator.validate(['a@example.com'])['a@example.com'])
+        validator = MXValidator(resolver=resolver, smtp_check=True,
+                                smtp_port=closed_port, timeout=5)
+        self.assertFalse(
+            validator.validate(['a@example.com'])['a@example.com'])
+        server.socket.close()
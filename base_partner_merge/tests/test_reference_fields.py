@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+from mock import patch
+
+import openerp.tests.common as common
+
+
+class TestReferenceFields(common.TransactionCase):
+
+    def setUp(self):
+        super(TestReferenceFields, self).setUp()
+        self.wizard_model = self.env['base.partner.merge.automatic.wizard']
+        partner_model = self.env['res.partner']
+        self.src = partner_model.create({'name': 'Reference Fields Test'})
+        self.dst = partner_model.create({'name': 'Reference Fields Test'})
+        self.follower = partner_model.create(
+            {'name': 'Reference Fields Follower'})
+        self.other_follower = partner_model.create(
+            {'name': 'Reference Fields Other Follower'})
+        self.attachment = self.env['ir.attachment'].create({
+            'name': 'Reference Fields Attachment',
+            'res_model': 'res.partner',
+            'res_id': self.src.id})
+        self.message = self.env['mail.message'].browse(
+            self.src.message_post(body='Reference Fields Message'))
+        # the destination already has the first follower
+        self.src.message_subscribe(
+            [self.follower.id, self.other_follower.id])
+        self.dst.message_subscribe([self.follower.id])
+        # a stored reference field, the comment of a third partner
+        self.referrer = partner_model.create({
+            'name': 'Reference Fields Referrer',
+            'comment': 'res.partner,%d' % self.src.id})
+        registry_model = self.registry('base.partner.merge.automatic.wizard')
+        model_targets, reference_targets = (
+            registry_model._get_reference_targets(self.cr))
+        self.targets = (model_targets, reference_targets +
+                        (('res.partner', 'res_partner', 'comment'),))
+
+    def _followers(self, partner):
+        self.cr.execute("SELECT partner_id FROM mail_followers "
+                        "WHERE res_model = 'res.partner' AND res_id = %s",
+                        (partner.id,))
+        return sorted(row[0] for row in self.cr.fetchall())
+
+    def _check_merged(self):
+        self.env.invalidate_all()
+        self.assertFalse(self.src.exists())
+        self.assertEqual(self.attachment.res_id, self.dst.id)
+        self.assertEqual(self.message.res_id, self.dst.id)
+        self.assertEqual(
+            [partner_id for partner_id in self._followers(self.dst)
+             if partner_id in (self.follower.id, self.other_follower.id)],
+            sorted([self.follower.id, self.other_follower.id]))
+        self.assertFalse(self._followers(self.src))
+        self.assertEqual(self.referrer.comment,
+                         'res.partner,%d' % self.dst.id)
+
+    def _patch_targets(self):
+        targets = self.targets
+        return patch.object(type(self.wizard_model), '_get_reference_targets',
+                            lambda self, cr: targets)
+
+    def test_merge(self):
+        with self._patch_targets():
+            self.wizard_model._merge([self.src.id, self.dst.id],
+                                     dst_partner=self.dst)
+        self._check_merged()
+
+    def test_merge_groups(self):
+        with self._patch_targets():
+            self.wizard_model.merge_groups([(self.dst.id, [self.src.id])],
+                                           commit=False)
+        self._check_merged()
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+import logging
+import time
+
+import openerp.tests.common as common
+
+from ..base_partner_merge import sanitize_email, sanitize_emails
+
+_logger = logging.getLogger(__name__)
+
+
+class TestSanitizeEmail(common.TransactionCase):
+
+    def test_sanitize_email(self):
+        self.assertEqual(sanitize_email('Foo <Foo@Example.com>'),
+                         ['foo@example.com'])
+        self.assertEqual(sanitize_email('a@example.com; b@example.com'),
+                         ['a@example.com', 'b@example.com'])
+        self.assertEqual(sanitize_email('a@example.com/b@example.com'),
+                         ['a@example.com', 'b@example.com'])
+        self.assertEqual(sanitize_email('not an email'), [])
+        self.assertEqual(sanitize_emails(['A@example.com', False]),
+                         [['a@example.com'], []])
+
+    def test_sanitize_emails_benchmark(self):
+        """Log the number of addresses sanitized per second"""
+        emails = ['Contact %d <contact%d@example%d.com>, other%d@example.com'
+                  % (i, i, i % 100, i) for i in xrange(5000)]
+        start = time.time()
+        result = sanitize_emails(emails)
+        duration = max(time.time() - start, 1e-6)
+        _logger.info('sanitize_emails: %d addresses/second',
+                     len(emails) * 2 / duration)
+        self.assertEqual(result[42], ['contact42@example42.com',
+                                      'other42@example.com'])
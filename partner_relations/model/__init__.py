@@ -21,6 +21,17 @@
 
 PADDING = 10
 
+# validity of a relation as a date range, null dates being unbounded
+RELATION_DATE_RANGE = "daterange(date_start, date_end, '[]')"
+
+
+def create_index(cr, name, table, columns, method='btree'):
+    """Create the index name on columns of table if it does not exist"""
+    cr.execute('SELECT 1 FROM pg_indexes WHERE indexname = %s', (name,))
+    if not cr.fetchone():
+        cr.execute('CREATE INDEX "%s" ON "%s" USING %s (%s)' % (
+            name, table, method, ', '.join(columns)))
+
 
 def get_partner_type(partner):
     """Get partner type for relation.
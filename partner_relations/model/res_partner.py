@@ -24,6 +24,22 @@ from openerp import osv, models, fields, exceptions, api
 from openerp.osv.expression import is_leaf, AND, OR, FALSE_LEAF
 from openerp.tools import DEFAULT_SERVER_DATE_FORMAT
 from openerp.tools.translate import _
+from . import RELATION_DATE_RANGE
+
+# conditions on the date range of the relations for the operators of
+# search_relation_date
+RELATION_DATE_OPERATORS = {
+    '=': "%(range)s @> %%s::date",
+    '!=': "not %(range)s @> %%s::date",
+    '<': "%(range)s && daterange(null, %%s::date, '()')",
+    '<=': "%(range)s && daterange(null, %%s::date, '(]')",
+    '>': "%(range)s && daterange(%%s::date, null, '()')",
+    '>=': "%(range)s && daterange(%%s::date, null, '[)')",
+}
+
+# default number of relations between the partners searched with
+# relation_network_partner_id
+RELATION_NETWORK_DEPTH = 3
 
 
 class ResPartner(models.Model):
@@ -34,41 +50,87 @@ class ResPartner(models.Model):
         compute="_count_relations"
     )
 
-    @api.one
+    @api.multi
     @api.depends("relation_ids")
     def _count_relations(self):
-        """Count the number of relations this partner has for Smart Button
+        """Count the number of relations the partners have for Smart Button,
+        in one query for all of them
 
-        Don't count inactive relations.
+        Don't count inactive relations, nor twice the relations of a
+        partner with itself.
         """
-        self.relation_count = len([r for r in self.relation_ids if r.active])
+        counts = {}
+        if self.ids:
+            self.env.cr.execute(
+                '''select partner_id, count(*)
+                from (
+                    select left_partner_id as partner_id
+                    from res_partner_relation
+                    where left_partner_id in %s and active
+                    union all
+                    select right_partner_id
+                    from res_partner_relation
+                    where right_partner_id in %s and active
+                    and left_partner_id != right_partner_id
+                ) as relations
+                group by partner_id''',
+                (tuple(self.ids), tuple(self.ids))
+            )
+            counts = dict(self.env.cr.fetchall())
+        for partner in self:
+            partner.relation_count = counts.get(partner.id, 0)
 
     def _get_relation_ids_select(self, cr, uid, ids, field_name, arg,
-                                 context=None):
-        '''return the partners' relations as tuple
-        (id, left_partner_id, right_partner_id)'''
+                                 context=None, limit=None, offset=0):
+        '''return the partners' relations as tuple (partner_id, id)
+
+        The relations are looked up by left and by right partner in two
+        index scans, the second one skipping the relations of a partner
+        with itself. limit and offset page the relations of every partner
+        on its own.'''
+        ranks = 'rank > %(offset)s'
+        if limit is not None:
+            ranks += ' and rank <= %(offset)s + %(limit)s'
         cr.execute(
-            '''select id, left_partner_id, right_partner_id
-            from res_partner_relation
-            where (left_partner_id in %s or right_partner_id in %s)''' +
-            ' order by ' + self.pool['res.partner.relation']._order,
-            (tuple(ids), tuple(ids))
+            '''select partner_id, id
+            from (
+                select partner_id, id, row_number() over (
+                    partition by partner_id
+                    order by ''' + self.pool['res.partner.relation']._order +
+            ''', id) as rank
+                from (
+                    select left_partner_id as partner_id, *
+                    from res_partner_relation
+                    where left_partner_id in %(ids)s
+                    union all
+                    select right_partner_id as partner_id, *
+                    from res_partner_relation
+                    where right_partner_id in %(ids)s
+                    and left_partner_id != right_partner_id
+                ) as relation
+            ) as relation
+            where ''' + ranks + '''
+            order by partner_id, rank''',
+            {'ids': tuple(ids), 'limit': limit, 'offset': offset or 0}
         )
         return cr.fetchall()
 
     def _get_relation_ids(
             self, cr, uid, ids, field_name, arg, context=None):
-        '''getter for relation_ids'''
+        '''getter for relation_ids
+
+        Context keys partner_relations_limit and partner_relations_offset
+        page the relations of every partner, for partners with a lot of
+        them.'''
         if context is None:
             context = {}
         result = dict([(i, []) for i in ids])
         # TODO: do a permission test on returned ids
-        for row in self._get_relation_ids_select(
-                cr, uid, ids, field_name, arg, context=context):
-            if row[1] in result:
-                result[row[1]].append(row[0])
-            if row[2] in result:
-                result[row[2]].append(row[0])
+        for partner_id, relation_id in self._get_relation_ids_select(
+                cr, uid, ids, field_name, arg, context=context,
+                limit=context.get('partner_relations_limit'),
+                offset=context.get('partner_relations_offset', 0)):
+            result[partner_id].append(relation_id)
         return result
 
     def _set_relation_ids(
@@ -170,22 +232,31 @@ class ResPartner(models.Model):
         return result
 
     def _search_relation_date(self, cr, uid, obj, name, args, context=None):
+        '''search the partners with a relation valid on the given date (=),
+        not valid on it (!=), or valid at some time before (<, <=) or
+        after (>, >=) it
+
+        The validity of the relations is compared with the range operators
+        of PostgreSQL, served by the GiST index on their date range.'''
         result = []
         for arg in args:
             if isinstance(arg, tuple) and arg[0] == name:
-                # TODO: handle {<,>}{,=}
-                if arg[1] != '=':
+                if arg[1] not in RELATION_DATE_OPERATORS:
+                    raise exceptions.ValidationError(
+                        _('Unsupported search operand "%s"') % arg[1])
+                if not arg[2]:
                     continue
 
-                result.extend([
-                    '&',
-                    '|',
-                    ('relation_all_ids.date_start', '=', False),
-                    ('relation_all_ids.date_start', '<=', arg[2]),
-                    '|',
-                    ('relation_all_ids.date_end', '=', False),
-                    ('relation_all_ids.date_end', '>=', arg[2]),
-                ])
+                cr.execute(
+                    '''select id from res_partner_relation_all
+                    where ''' + RELATION_DATE_OPERATORS[arg[1]] % {
+                        'range': RELATION_DATE_RANGE},
+                    (arg[2],))
+                result.append((
+                    'relation_all_ids.id',
+                    'in',
+                    [row[0] for row in cr.fetchall()],
+                ))
 
         return result
 
@@ -217,6 +288,95 @@ class ResPartner(models.Model):
 
         return result
 
+    def _search_relation_network_partner_id(
+            self, cr, uid, dummy_obj, name, args, context=None):
+        '''search the partners related to the given partners through at
+        most partner_relations_depth (from the context) active relations
+        valid today, of the types partner_relations_type_ids if given'''
+        if context is None:
+            context = {}
+        result = []
+        for arg in args:
+            if isinstance(arg, tuple) and arg[0] == name:
+                if arg[1] not in ['=', 'in']:
+                    raise exceptions.ValidationError(
+                        _('Unsupported search operand "%s"') % arg[1])
+                partner_ids = arg[2]
+                if isinstance(partner_ids, (long, int)):
+                    partner_ids = [partner_ids]
+                today = time.strftime(DEFAULT_SERVER_DATE_FORMAT)
+                network = self.browse(
+                    cr, uid, partner_ids, context=context
+                ).get_relation_network(
+                    max_depth=context.get(
+                        'partner_relations_depth', RELATION_NETWORK_DEPTH),
+                    type_ids=context.get('partner_relations_type_ids'),
+                    date_from=today, date_to=today)
+                result.append(('id', 'in', network.keys()))
+
+        return result
+
+    @api.multi
+    def get_relation_network(self, max_depth=1, type_ids=None,
+                             date_from=None, date_to=None,
+                             include_inactive=False):
+        '''return the partners reachable from these partners through at
+        most max_depth relations, in either direction, as a dictionary
+        {partner id: length of the shortest path}
+
+        The graph is walked breadth first, with one query per level which
+        follows the relations of the partners reached at the previous
+        level, by left and by right partner in two index scans. The
+        partners already reached are dropped from the result of each level
+        with a set, so they don't weigh on the query.
+
+        :param type_ids: ids of the res.partner.relation.type to follow,
+                         all by default
+        :param date_from: only follow the relations not ended before
+        :param date_to: only follow the relations not started after
+        :param include_inactive: also follow the inactive relations
+        '''
+        if not self.ids or max_depth < 1:
+            return {}
+        conditions = []
+        params = {}
+        if type_ids:
+            conditions.append('type_id in %(type_ids)s')
+            params['type_ids'] = tuple(type_ids)
+        if date_from:
+            conditions.append('(date_end is null or '
+                              'date_end >= %(date_from)s)')
+            params['date_from'] = date_from
+        if date_to:
+            conditions.append('(date_start is null or '
+                              'date_start <= %(date_to)s)')
+            params['date_to'] = date_to
+        if not include_inactive:
+            conditions.append('active')
+        conditions = ''.join(' and ' + condition for condition in conditions)
+        query = (
+            '''select right_partner_id
+            from res_partner_relation
+            where left_partner_id = any(%(frontier)s)''' + conditions +
+            '''
+            union
+            select left_partner_id
+            from res_partner_relation
+            where right_partner_id = any(%(frontier)s)''' + conditions)
+        result = {}
+        visited = set(self.ids)
+        frontier = list(visited)
+        for depth in range(1, max_depth + 1):
+            params['frontier'] = frontier
+            self.env.cr.execute(query, params)
+            frontier = [row[0] for row in self.env.cr.fetchall()
+                        if row[0] not in visited]
+            if not frontier:
+                break
+            result.update((partner_id, depth) for partner_id in frontier)
+            visited.update(frontier)
+        return result
+
     _columns = {
         'relation_ids': osv.fields.function(
             lambda self, *args, **kwargs: self._get_relation_ids(
@@ -259,6 +419,13 @@ class ResPartner(models.Model):
             string='Has relation with a partner in category',
             type='many2one', obj='res.partner.category'
         ),
+        'relation_network_partner_id': osv.fields.function(
+            lambda self, cr, uid, ids, *args: dict([
+                (i, False) for i in ids]),
+            fnct_search=_search_relation_network_partner_id,
+            string='Related (directly or not) to',
+            type='many2one', obj='res.partner'
+        ),
     }
 
     def copy_data(self, cr, uid, id, default=None, context=None):
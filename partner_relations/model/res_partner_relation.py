@@ -20,9 +20,12 @@
 #
 ##############################################################################
 
+import logging
 from openerp import osv, models, fields, api, exceptions, _
 
-from . import get_partner_type
+from . import create_index, get_partner_type, RELATION_DATE_RANGE
+
+_logger = logging.getLogger(__name__)
 
 
 class ResPartnerRelation(models.Model):
@@ -138,6 +141,34 @@ class ResPartnerRelation(models.Model):
     date_end = fields.Date('Ending date')
     active = fields.Boolean('Active', default=True)
 
+    _relation_indexes = [
+        ('res_partner_relation_left_active_index',
+         ['left_partner_id', 'active']),
+        ('res_partner_relation_right_active_index',
+         ['right_partner_id', 'active']),
+        ('res_partner_relation_type_active_index', ['type_id', 'active']),
+    ]
+
+    def _auto_init(self, cr, context=None):
+        """Index the columns res.partner.relation.all is searched on, each
+        half of the view being a scan of this table"""
+        res = super(ResPartnerRelation, self)._auto_init(cr, context=context)
+        for name, columns in self._relation_indexes:
+            create_index(cr, name, self._table, columns)
+        # searches on the validity of the relations, see
+        # res.partner's search_relation_date. The relations stored before
+        # _check_dates may end before they start, which the date range
+        # rejects
+        cr.execute('UPDATE "%s" SET date_start = date_end, '
+                   'date_end = date_start '
+                   'WHERE date_start > date_end' % self._table)
+        if cr.rowcount:
+            _logger.warning('swapped the dates of %d relations ending '
+                            'before they start', cr.rowcount)
+        create_index(cr, 'res_partner_relation_date_range_index',
+                     self._table, [RELATION_DATE_RANGE], method='gist')
+        return res
+
     @api.one
     @api.depends('left_partner_id', 'right_partner_id')
     def _get_partner_type_any(self):
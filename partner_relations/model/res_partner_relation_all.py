@@ -94,6 +94,9 @@ class ResPartnerRelationAll(models.AbstractModel):
     active = fields.Boolean('Active', default=True)
 
     def _auto_init(self, cr, context=None):
+        """Both halves of the view have distinct ids, so they are joined
+        with union all: the conditions on the view are then pushed down to
+        each half, which uses the indexes of res_partner_relation"""
         drop_view_if_exists(cr, self._table)
         additional_view_fields = ','.join(self._additional_view_fields)
         additional_view_fields = (',' + additional_view_fields)\
@@ -114,7 +117,7 @@ class ResPartnerRelationAll(models.AbstractModel):
                 type_id * %(padding)d as type_selection_id
                 %(additional_view_fields)s
             from %(underlying_table)s
-            union select
+            union all select
                 id * %(padding)d + 1,
                 id,
                 type_id,
@@ -79,3 +79,178 @@ class TestPartnerRelation(common.TransactionCase):
             self.relation_model.create({'type_id': self.relation_default.id,
                                         'left_partner_id': self.partner_1.id,
                                         'right_partner_id': self.partner_1.id})
+
+    def test_relation_all(self):
+        relation = self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': self.partner_1.id,
+            'right_partner_id': self.partner_2.id})
+        relation_all = self.env['res.partner.relation.all'].search(
+            [('relation_id', '=', relation.id)])
+        self.assertEqual(
+            sorted((r.record_type, r.this_partner_id, r.other_partner_id)
+                   for r in relation_all),
+            [('a', self.partner_1, self.partner_2),
+             ('b', self.partner_2, self.partner_1)])
+        partners = self.partner_model.search(
+            [('search_relation_id', '=',
+              relation_all.filtered(
+                  lambda r: r.record_type == 'a').type_selection_id.id)])
+        self.assertEqual(partners, self.partner_1)
+
+    def test_relation_count(self):
+        partner_3 = self.partner_model.create({'name': 'Test User 3'})
+        self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': self.partner_1.id,
+            'right_partner_id': self.partner_2.id})
+        self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': partner_3.id,
+            'right_partner_id': self.partner_1.id})
+        self.relation_model.create({
+            'type_id': self.relation_default.id,
+            'left_partner_id': self.partner_2.id,
+            'right_partner_id': partner_3.id,
+            'active': False})
+        partners = self.partner_1 | self.partner_2 | partner_3
+        partners.invalidate_cache()
+        self.assertEqual(partners.mapped('relation_count'), [2, 1, 1])
+
+    def test_relation_count_self(self):
+        self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': self.partner_1.id,
+            'right_partner_id': self.partner_1.id})
+        self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': self.partner_1.id,
+            'right_partner_id': self.partner_2.id})
+        partners = self.partner_1 | self.partner_2
+        partners.invalidate_cache()
+        self.assertEqual(partners.mapped('relation_count'), [2, 1])
+
+    def test_relation_ids_paging(self):
+        partner_3 = self.partner_model.create({'name': 'Test User 3'})
+        relation_1 = self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': self.partner_1.id,
+            'right_partner_id': self.partner_2.id,
+            'date_start': '2015-01-01'})
+        relation_2 = self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': partner_3.id,
+            'right_partner_id': self.partner_1.id,
+            'date_start': '2014-01-01'})
+        relation_3 = self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': self.partner_1.id,
+            'right_partner_id': self.partner_1.id,
+            'date_start': '2013-01-01'})
+        self.partner_1.invalidate_cache()
+        self.assertEqual(self.partner_1.relation_ids,
+                         relation_1 | relation_2 | relation_3)
+        partner = self.partner_1.with_context(partner_relations_limit=1,
+                                              partner_relations_offset=1)
+        partner.invalidate_cache()
+        self.assertEqual(partner.relation_ids, relation_2)
+        # the relations of every partner are paged on their own, also
+        # when they are read for several partners at once
+        partners = (self.partner_1 | partner_3).with_context(
+            partner_relations_limit=1)
+        partners.invalidate_cache()
+        self.assertEqual(partners[0].relation_ids, relation_1)
+        self.assertEqual(partners[1].relation_ids, relation_2)
+        partners = partners.with_context(partner_relations_offset=1)
+        partners.invalidate_cache()
+        self.assertEqual(partners[0].relation_ids, relation_2)
+        self.assertFalse(partners[1].relation_ids)
+
+    def test_relation_network(self):
+        partner_3 = self.partner_model.create({'name': 'Test User 3'})
+        partner_4 = self.partner_model.create({'name': 'Test User 4'})
+        self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': self.partner_1.id,
+            'right_partner_id': self.partner_2.id})
+        self.relation_model.create({
+            'type_id': self.relation_default.id,
+            'left_partner_id': partner_3.id,
+            'right_partner_id': self.partner_2.id})
+        self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': partner_3.id,
+            'right_partner_id': partner_4.id,
+            'date_end': '2010-12-31'})
+
+        self.assertEqual(self.partner_1.get_relation_network(max_depth=2),
+                         {self.partner_2.id: 1, partner_3.id: 2})
+        self.assertEqual(self.partner_1.get_relation_network(max_depth=5),
+                         {self.partner_2.id: 1, partner_3.id: 2,
+                          partner_4.id: 3})
+        self.assertEqual(
+            self.partner_1.get_relation_network(
+                max_depth=5, date_from='2015-01-01'),
+            {self.partner_2.id: 1, partner_3.id: 2})
+        self.assertEqual(
+            self.partner_1.get_relation_network(
+                max_depth=5, type_ids=self.relation_allow.ids),
+            {self.partner_2.id: 1})
+
+        partners = self.partner_model.search(
+            [('relation_network_partner_id', '=', self.partner_1.id)])
+        self.assertEqual(partners, self.partner_2 | partner_3)
+
+    def test_search_relation_date(self):
+        partner_3 = self.partner_model.create({'name': 'Test User 3'})
+        self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': self.partner_1.id,
+            'right_partner_id': self.partner_2.id,
+            'date_start': '2010-01-01',
+            'date_end': '2010-12-31'})
+        self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': partner_3.id,
+            'right_partner_id': self.partner_2.id,
+            'date_start': '2015-01-01'})
+        all_partners = self.partner_1 | self.partner_2 | partner_3
+
+        def search(operator, date):
+            return self.partner_model.search([
+                ('id', 'in', all_partners.ids),
+                ('search_relation_date', operator, date)])
+
+        self.assertEqual(search('=', '2010-06-01'),
+                         self.partner_1 | self.partner_2)
+        self.assertEqual(search('=', '2016-06-01'),
+                         self.partner_2 | partner_3)
+        self.assertEqual(search('!=', '2016-06-01'),
+                         self.partner_1 | self.partner_2)
+        self.assertEqual(search('<', '2010-01-01'), self.partner_model)
+        self.assertEqual(search('<=', '2010-01-01'),
+                         self.partner_1 | self.partner_2)
+        self.assertEqual(search('>', '2010-12-31'),
+                         self.partner_2 | partner_3)
+        self.assertEqual(search('>=', '2010-12-31'), all_partners)
+        with self.assertRaises(ValidationError):
+            search('like', '2010')
+
+    def test_date_range_index(self):
+        relation = self.relation_model.create({
+            'type_id': self.relation_allow.id,
+            'left_partner_id': self.partner_1.id,
+            'right_partner_id': self.partner_2.id})
+        # the relations stored before _check_dates
+        self.cr.execute('DROP INDEX res_partner_relation_date_range_index')
+        self.cr.execute("UPDATE res_partner_relation "
+                        "SET date_start = '2011-01-01', "
+                        "date_end = '2010-01-01' WHERE id = %s",
+                        (relation.id,))
+        self.registry('res.partner.relation')._auto_init(self.cr, {})
+        self.cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = "
+                        "'res_partner_relation_date_range_index'")
+        self.assertTrue(self.cr.fetchone())
+        relation.invalidate_cache()
+        self.assertEqual(relation.date_start, '2010-01-01')
+        self.assertEqual(relation.date_end, '2011-01-01')